@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+'''
+SPDX-License-Identifier: MPL-2.0
+SPDX-FileCopyrightText: 2023 Martin Cerveny <martin@c-home.cz>
+'''
+
+# load benchmark of chunks and mats endpoints, compare servers started with
+# JCSRV_SERVER=flask (development server) and JCSRV_SERVER=waitress:
+#   jc-bench.py -u http://srv1:5000 -u http://srv2:5000 -c 64 -d 20
+
+import argparse
+import concurrent.futures
+import datetime
+import time
+
+import requests
+
+parser = argparse.ArgumentParser(description="jc-srv load benchmark")
+parser.add_argument("-u", "--url", action="append", help="server base url (repeat to compare)")
+parser.add_argument("-c", "--clients", type=int, default=32, help="concurrent clients (keep-alive session each)")
+parser.add_argument("-d", "--duration", type=float, default=10.0, help="seconds per endpoint")
+parser.add_argument("-t", "--timeout", type=float, default=10.0, help="request timeout")
+parser.add_argument("--day", default=datetime.datetime.now().strftime("%Y-%m-%d"), help="day")
+parser.add_argument("--camid", type=int, default=1, help="camid for per cam chunks")
+parser.add_argument("--matid", type=int, default=1, help="matid for per mat mats")
+args = parser.parse_args()
+
+ENDPOINTS = [
+    ("chunks", "/api/v1/chunks/%s" % args.day),
+    ("chunks/cam", "/api/v1/chunks/%s/%d" % (args.day, args.camid)),
+    ("mats", "/api/v1/mats/%s" % args.day),
+    ("mats/mat", "/api/v1/mats/%s/%d" % (args.day, args.matid)),
+]
+
+
+def client(url, deadline):
+    latencies = []
+    errors = 0
+    session = requests.Session()
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            response = session.get(url, timeout=args.timeout)
+            response.content
+            if response.status_code != 200:
+                errors += 1
+                continue
+        except requests.RequestException:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    session.close()
+    return latencies, errors
+
+
+def percentile(latencies, p):
+    if not latencies:
+        return float("nan")
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+
+
+def bench(base, path):
+    deadline = time.time() + args.duration
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.clients) as executor:
+        results = list(executor.map(lambda _: client(base + path, deadline), range(args.clients)))
+    latencies = sorted(latency for result in results for latency in result[0])
+    errors = sum(result[1] for result in results)
+    return dict(rps=len(latencies) / args.duration, p50=percentile(latencies, 50), p95=percentile(latencies, 95),
+                p99=percentile(latencies, 99), max=percentile(latencies, 100), errors=errors)
+
+
+def ident(base):
+    # "Server" header tells the serving stack (waitress or werkzeug)
+    try:
+        return requests.get(base + ENDPOINTS[2][1], timeout=args.timeout).headers.get("Server", "?")
+    except requests.RequestException:
+        return "unreachable"
+
+
+print(f"clients {args.clients} duration {args.duration}s day {args.day}")
+print(f"{'server':32} {'endpoint':12} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7}")
+for base in args.url or ["http://localhost:5000"]:
+    base = base.rstrip("/")
+    print(f"# {base} {ident(base)}")
+    for name, path in ENDPOINTS:
+        r = bench(base, path)
+        print(f"{base:32} {name:12} {r['rps']:9.1f} {r['p50']:9.1f} {r['p95']:9.1f} {r['p99']:9.1f} {r['max']:9.1f} {r['errors']:7d}")
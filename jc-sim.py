@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+'''
+SPDX-License-Identifier: MPL-2.0
+SPDX-FileCopyrightText: 2023 Martin Cerveny <martin@c-home.cz>
+'''
+
+# local multi-node simulation of jc-srv: N instances on localhost ports, fake cameras
+# (TCP listeners on 127.0.0.<camid>), a stub recorder writing .ts chunks and a temporary
+# share directory, benchmarks per number of nodes and cameras:
+#   jc-sim.py -n 1,3,5 -c 4,16,32
+# the stub recorder is this script: jc-sim.py recorder <daydir> <camname> <mat> <position>
+
+import argparse
+import concurrent.futures
+import datetime
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+JCSRV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jc-srv.py")
+
+
+def recorder(argv):
+    # stand-in for jc-cam: one chunk named by hex milisec timestamp every JCSIM_CHUNK seconds
+    path = os.path.join(argv[0], argv[1])
+    os.makedirs(path, exist_ok=True)
+    interval = float(os.environ.get("JCSIM_CHUNK", "2.0"))
+    size = int(os.environ.get("JCSIM_CHUNKSIZE", "65536"))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    parent = os.getppid()
+    while os.getppid() == parent:
+        with open(os.path.join(path, format(int(time.time() * 1000), "011x") + ".ts"), "wb") as f:
+            f.write(b"\0" * size)
+        time.sleep(interval)
+
+
+class Camera:
+    # accepts and drops connections like an RTSP port, enough for the jc-srv probe
+    def __init__(self, camid, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((f"127.0.0.{camid}", port))
+        self.sock.listen(64)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+                conn.close()
+            except OSError:
+                return
+
+    def close(self):
+        # shutdown wakes the blocked accept(), close alone keeps the port bound for the next cluster
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Cluster:
+    def __init__(self, nodes, ncams, args):
+        self.args = args
+        self.nodes = nodes
+        self.tmp = tempfile.mkdtemp(prefix="jc-sim-")
+        self.share = os.path.join(self.tmp, "share")
+        self.camexec = os.path.join(self.tmp, "jc-cam")
+        with open(self.camexec, "w") as f:
+            f.write(f"#!/bin/sh\nexec {sys.executable} {os.path.abspath(__file__)} recorder \"$@\"\n")
+        os.chmod(self.camexec, 0o755)
+        self.cameras = {camid: Camera(camid, args.camport) for camid in range(1, ncams + 1)}
+        self.processes = {}
+        self.session = requests.Session()
+        for srvid in range(1, nodes + 1):
+            self.start(srvid)
+
+    def port(self, srvid):
+        return int(f"{self.args.port_prefix}{srvid:02d}")
+
+    def url(self, srvid, path):
+        return f"http://127.0.0.1:{self.port(srvid)}/api/v1{path}"
+
+    def start(self, srvid):
+        os.makedirs(os.path.join(self.share, f"srv{srvid}"), exist_ok=True)
+        env = dict(os.environ,
+                   JCSRV_HOSTNAME=f"srv{srvid}",
+                   JCSRV_SHARE=self.share,
+                   JCSRV_PORT=str(self.port(srvid)),
+                   JCSRV_RESTPREFIX=f"http://127.0.0.1:{self.args.port_prefix}%02d/api/v1",
+                   JCSRV_CAMHOST="127.0.0.%d",
+                   JCSRV_CAMPROBEPORT=str(self.args.camport),
+                   JCSRV_CAMEXEC=self.camexec,
+                   JCSRV_HBADDR="127.255.255.255",
+                   JCSRV_HBPORT=str(self.args.hbport),
+                   JCSRV_SIMULATION="1",
+                   JCSIM_CHUNK=str(self.args.chunk))
+        log = open(os.path.join(self.tmp, f"srv{srvid}.log"), "a")
+        # own process group with its recorders, killed together
+        self.processes[srvid] = subprocess.Popen([sys.executable, JCSRV], env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def killgroup(self, process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+    def kill(self, srvid):
+        self.killgroup(self.processes[srvid])
+        del self.processes[srvid]
+
+    def get(self, srvid, path):
+        return self.session.get(self.url(srvid, path), timeout=self.args.timeout)
+
+    def wait(self, predicate, timeout):
+        # seconds until predicate holds, None on timeout
+        start = time.time()
+        while time.time() - start < timeout:
+            try:
+                if predicate():
+                    return time.time() - start
+            except (requests.RequestException, ValueError, KeyError):
+                pass
+            time.sleep(0.05)
+        return None
+
+    def up(self):
+        return all(self.get(srvid, "/recording").status_code == 200 for srvid in self.processes)
+
+    def owners(self, camid):
+        return set(self.get(srvid, f"/recording/{camid}").json()["srvid"] for srvid in self.processes)
+
+    def converged(self):
+        # every camera has one recording server, alive and agreed on by all nodes
+        for camid in self.cameras:
+            owners = self.owners(camid)
+            if len(owners) != 1 or owners.pop() not in self.processes:
+                return False
+        return True
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                pass
+            # recorders left behind by a node that did not stop them
+            self.killgroup(process)
+        for camera in self.cameras.values():
+            camera.close()
+        self.session.close()
+        if self.args.keep:
+            print(f"# logs and share kept in {self.tmp}")
+        else:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def scancycle(cluster):
+    # mean live_thread sweep in ms, worst node
+    worst = 0.0
+    for srvid in cluster.processes:
+        values = {}
+        for line in cluster.session.get(f"http://127.0.0.1:{cluster.port(srvid)}/metrics", timeout=cluster.args.timeout).text.splitlines():
+            if line.startswith("jcsrv_live_cycle_seconds_sum") or line.startswith("jcsrv_live_cycle_seconds_count"):
+                name, value = line.split()
+                values[name] = float(value)
+        if values.get("jcsrv_live_cycle_seconds_count"):
+            worst = max(worst, values["jcsrv_live_cycle_seconds_sum"] / values["jcsrv_live_cycle_seconds_count"] * 1000)
+    return worst
+
+
+def replication(cluster, day, rounds=10):
+    # median ms until a bookmark added on srv1 is visible on every other node
+    latencies = []
+    for i in range(rounds):
+        start = time.time()
+        item = cluster.session.post(cluster.url(1, f"/mats/{day}/1/bookmarks"), json=dict(sim=i), timeout=cluster.args.timeout).json()
+        others = [srvid for srvid in cluster.processes if srvid != 1]
+        if cluster.wait(lambda: all(any(bookmark.get("id") == item["id"] for bookmark in cluster.get(srvid, f"/mats/{day}/1").json()["bookmarks"]) for srvid in others), cluster.args.settle) is not None:
+            latencies.append((time.time() - start) * 1000)
+    return statistics.median(latencies) if latencies else None
+
+
+def throughput(cluster, day):
+    # Chunks.get on srv1 with fan-out to all peers
+    deadline = time.time() + cluster.args.duration
+
+    def client():
+        session = requests.Session()
+        latencies = []
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                if session.get(cluster.url(1, f"/chunks/{day}"), timeout=cluster.args.timeout).status_code == 200:
+                    latencies.append(time.perf_counter() - start)
+            except requests.RequestException:
+                pass
+        session.close()
+        return latencies
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=cluster.args.clients) as executor:
+        latencies = sorted(sum(executor.map(lambda _: client(), range(cluster.args.clients)), []))
+    if not latencies:
+        return 0.0, None
+    return len(latencies) / cluster.args.duration, latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+
+
+def restart(cluster, day):
+    # a bookmark of today survives a restart of the whole cluster (no peer can hand it back)
+    first = min(cluster.processes)
+    item = cluster.session.post(cluster.url(first, f"/mats/{day}/1/bookmarks"), json=dict(sim="restart"), timeout=cluster.args.timeout).json()
+    for srvid in list(cluster.processes):
+        cluster.kill(srvid)
+    for srvid in range(1, cluster.nodes + 1):
+        cluster.start(srvid)
+    if cluster.wait(cluster.up, cluster.args.settle) is None:
+        return False
+    return any(bookmark.get("id") == item["id"] for bookmark in cluster.get(first, f"/mats/{day}/1").json()["bookmarks"])
+
+
+def failover(cluster):
+    # kill the recording server of cam1, seconds until the others agree on a new one
+    owner = cluster.owners(1).pop()
+    if len(cluster.processes) < 2 or owner not in cluster.processes:
+        return None
+    cluster.kill(owner)
+    return cluster.wait(cluster.converged, cluster.args.settle)
+
+
+def run(nodes, ncams, args):
+    day = datetime.datetime.now().strftime("%Y-%m-%d")
+    cluster = Cluster(nodes, ncams, args)
+    try:
+        if cluster.wait(cluster.up, args.settle) is None:
+            print(f"# {nodes} nodes did not come up, see logs in {cluster.tmp}")
+            return None
+        cluster.session.put(cluster.url(1, "/recording"), json=dict(recording=True), timeout=args.timeout)
+        result = dict(nodes=nodes, cams=ncams, converge=cluster.wait(cluster.converged, args.settle))
+        # let chunks accumulate before measuring reads
+        time.sleep(args.chunk * 2)
+        result["scan"] = scancycle(cluster)
+        result["repl"] = replication(cluster, day) if nodes > 1 else None
+        result["rps"], result["p99"] = throughput(cluster, day)
+        result["failover"] = failover(cluster)
+        result["restart"] = restart(cluster, day)
+        return result
+    finally:
+        cluster.stop()
+
+
+def fmt(value, spec):
+    return format(value, spec) if value is not None else "-"
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "recorder":
+        recorder(sys.argv[2:])
+        sys.exit(0)
+
+    import requests
+
+    parser = argparse.ArgumentParser(description="jc-srv local cluster simulation")
+    parser.add_argument("-n", "--nodes", default="1,3", help="comma separated node counts")
+    parser.add_argument("-c", "--cams", default="4,16", help="comma separated camera counts (max 32)")
+    parser.add_argument("--port-prefix", default="62", help="node N listens on <prefix><NN>")
+    parser.add_argument("--camport", type=int, default=7554, help="fake camera port")
+    parser.add_argument("--hbport", type=int, default=7001, help="heartbeat port")
+    parser.add_argument("--chunk", type=float, default=2.0, help="stub recorder chunk seconds")
+    parser.add_argument("--clients", type=int, default=16, help="Chunks.get concurrent clients")
+    parser.add_argument("-d", "--duration", type=float, default=5.0, help="Chunks.get seconds")
+    parser.add_argument("-t", "--timeout", type=float, default=5.0, help="request timeout")
+    parser.add_argument("--settle", type=float, default=30.0, help="max seconds to wait for convergence")
+    parser.add_argument("--keep", action="store_true", help="keep share and logs")
+    args = parser.parse_args()
+
+    print(f"{'nodes':>5} {'cams':>5} {'converge s':>10} {'scan ms':>8} {'repl ms':>8} {'chunks/s':>9} {'p99 ms':>8} {'failover s':>10} {'restart':>7}")
+    for nodes in [int(value) for value in args.nodes.split(",")]:
+        for ncams in [int(value) for value in args.cams.split(",")]:
+            r = run(nodes, ncams, args)
+            if r:
+                print(f"{r['nodes']:5d} {r['cams']:5d} {fmt(r['converge'], '10.2f')} {fmt(r['scan'], '8.1f')} {fmt(r['repl'], '8.1f')} "
+                      f"{r['rps']:9.1f} {fmt(r['p99'], '8.1f')} {fmt(r['failover'], '10.2f')} {'ok' if r['restart'] else 'LOST':>7}")
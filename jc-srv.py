@@ -4,33 +4,52 @@ SPDX-FileCopyrightText: 2023 Martin Cerveny <martin@c-home.cz>
 '''
 
 from inspect import currentframe
-from flask import Flask
+from flask import Flask, Response, stream_with_context, send_file, redirect
 from flask_restful import reqparse, abort, Api, Resource, request
 import requests
 import sys
 import threading
 import subprocess
+import select
 import datetime
 import os
 import shutil
 import re
 import socket
+import ipaddress
+import queue
+import concurrent.futures
+import ctypes
+import ctypes.util
+import struct
+import array
+import bisect
+import hashlib
+import hmac
+import collections
+import itertools
+import signal
 
 import json
 import time
+import random
 
-CAMEXEC = "/root/jc-cam"
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+CAMEXEC = os.environ.get("JCSRV_CAMEXEC", "/root/jc-cam")
 
 app = Flask(__name__)
 api = Api(app)
-lock = threading.Lock()
 
 parser_recording = reqparse.RequestParser(bundle_errors=True)
 parser_recording.add_argument('recording', type=bool, help='state stop or recording', required=True)
 
 parser_recording_cam = reqparse.RequestParser(bundle_errors=True)
 parser_recording_cam.add_argument('srvid', type=int, help='recording server for cam', required=True)
-parser_recording_cam.add_argument('ts', type=int, help='milisec timestamp recording server for cam', required=True)
+parser_recording_cam.add_argument('epoch', type=int, help='ownership epoch of cam', required=True)
 
 parser_cam = reqparse.RequestParser(bundle_errors=True)
 parser_cam.add_argument('mat', type=int, help='matid', required=True)
@@ -46,25 +65,126 @@ parser_mat.add_argument('medicals', type=list, location='json', help='medicals',
 parser_mat.add_argument('bookmarks', type=list, location='json', help='bookmarks', required=False)
 parser_mat.add_argument('ts', type=int, help='timestamp', required=False)
 
+parser_matitem = reqparse.RequestParser(bundle_errors=True)
+parser_matitem.add_argument('id', type=str, location='json', help='item id', required=False)
+parser_matitem.add_argument('ts', type=int, location='json', help='milisec timestamp', required=False)
+
+parser_sync = reqparse.RequestParser(bundle_errors=True)
+parser_sync.add_argument('cams', type=int, location='args', help='cams ts watermark', default=0)
+parser_sync.add_argument('players', type=int, location='args', help='players ts watermark', default=0)
+parser_sync.add_argument('mats', type=int, location='args', help='mats ts watermark', default=0)
+
+parser_chunks = reqparse.RequestParser(bundle_errors=True)
+parser_chunks.add_argument('from', type=lambda value: int(value, 16), location='args', help='first chunk hex timestamp', required=False)
+parser_chunks.add_argument('to', type=lambda value: int(value, 16), location='args', help='last chunk hex timestamp', required=False)
+parser_chunks.add_argument('since', type=lambda value: int(value, 16), location='args', help='chunks after hex timestamp', required=False)
+
 recording = False
 deleting = None
-cfgs = {}
-cfgslocal = []
+cfgslocal = set()
 today = datetime.datetime.now().strftime('%Y-%m-%d')
-hostname = os.uname()[1]
-srvid_own = int(hostname[-1])
-recordingfile = f"/share/{hostname}/{today}/RECORDING"
+hostname = os.environ.get("JCSRV_HOSTNAME", os.uname()[1])
+srvid_own = int(re.search(r'\d+$', hostname).group())
+SHARE = os.environ.get("JCSRV_SHARE", "/share")
+recordingfile = f"{SHARE}/{hostname}/{today}/RECORDING"
 pathcache = {}
+syncmarks = {}
 pathts = {}
 cams = {}
 srvs = {}
-players = {}
-mats = {}
+BOOTID = int(time.time())
 MAXMAT = 8
 MAXPOS = 4
-MAXTS = 999999999999999
-CHECKER = 3
-RESTPREFIX = "http://srv%d:5000/api/v1"
+MAXCAM = 32
+CAMHOST = os.environ.get("JCSRV_CAMHOST", "cam%02d")
+# local simulation (jc-sim.py): all nodes on loopback, X-JC-Srvid from there is trusted as is
+SIMULATION = os.environ.get("JCSRV_SIMULATION", "") == "1"
+CAMPROBEPORT = int(os.environ.get("JCSRV_CAMPROBEPORT", "554"))
+CAMPROBETIMEOUT = float(os.environ.get("JCSRV_CAMPROBETIMEOUT", "0.5"))
+CAMPROBEINTERVAL = float(os.environ.get("JCSRV_CAMPROBEINTERVAL", "1.0"))
+camalive = set()
+HBPORT = int(os.environ.get("JCSRV_HBPORT", "5001"))
+HBADDR = os.environ.get("JCSRV_HBADDR", "<broadcast>")
+HBINTERVAL = float(os.environ.get("JCSRV_HBINTERVAL", "0.2"))
+HBDEAD = float(os.environ.get("JCSRV_HBDEAD", "0.8"))
+HBJOIN = int(os.environ.get("JCSRV_HBJOIN", "2"))
+# shared secret signing X-JC-Srvid, peers are then recognized from any address
+PEERKEY = os.environ.get("JCSRV_PEERKEY", "")
+PEERIDTTL = float(os.environ.get("JCSRV_PEERIDTTL", "300"))
+PEERSIGWINDOW = float(os.environ.get("JCSRV_PEERSIGWINDOW", "30"))
+LEASEGRACE = float(os.environ.get("JCSRV_LEASEGRACE", "0.5"))
+LEASEWORKERS = int(os.environ.get("JCSRV_LEASEWORKERS", "8"))
+# a holder not hearing an alive member this long gives its leases up, before that member declares it
+# dead (HBDEAD) and takes the cams over
+LEASECONFIRM = max(HBDEAD - LEASEGRACE, HBINTERVAL)
+# membership must be complete before the first proposal
+LEASESTART = time.time() + HBDEAD + HBJOIN * HBINTERVAL
+epochs = {}
+orphaned = {}
+retryat = {}
+PLACEFREEMIN = int(os.environ.get("JCSRV_PLACEFREEMIN", str(10*1024**3)))
+PLACEWRITEUNIT = float(os.environ.get("JCSRV_PLACEWRITEUNIT", str(4*1024**2)))
+REBALANCEGAP = float(os.environ.get("JCSRV_REBALANCEGAP", "2"))
+REBALANCEINTERVAL = float(os.environ.get("JCSRV_REBALANCEINTERVAL", "60"))
+# leases and recorder counts of all servers must agree this long before a rebalance
+REBALANCESTABLE = float(os.environ.get("JCSRV_REBALANCESTABLE", "10"))
+HANDOVERWAIT = float(os.environ.get("JCSRV_HANDOVERWAIT", "30"))
+handovers = {}
+# (owns, handover) announced by the heartbeat, republished under lock whenever they change
+leases = ({}, {})
+rebalanced = time.time()
+settled = (None, time.time())
+ownload = {}
+hbwake = threading.Event()
+members = {}
+memberslock = threading.Lock()
+liveevents = queue.Queue()
+RPCTIMEOUT = float(os.environ.get("JCSRV_RPCTIMEOUT", "1.0"))
+RPCRETRIES = int(os.environ.get("JCSRV_RPCRETRIES", "2"))
+RPCBACKOFF = float(os.environ.get("JCSRV_RPCBACKOFF", "0.05"))
+RPCPOOLSIZE = int(os.environ.get("JCSRV_RPCPOOLSIZE", "8"))
+RPCWORKERS = int(os.environ.get("JCSRV_RPCWORKERS", "32"))
+RPCCACHEMAX = int(os.environ.get("JCSRV_RPCCACHEMAX", str(16 * 1024 * 1024)))
+CHUNKSDEADLINE = float(os.environ.get("JCSRV_CHUNKSDEADLINE", "1.0"))
+COALESCETTL = float(os.environ.get("JCSRV_COALESCETTL", "0.5"))
+CHUNKCACHEFILE = f"{SHARE}/{hostname}/chunkcache.json"
+CHUNKCACHEMAX = int(os.environ.get("JCSRV_CHUNKCACHEMAX", "1000000"))
+CHUNKCACHESAVE = float(os.environ.get("JCSRV_CHUNKCACHESAVE", "30"))
+CHUNKMAXAGE = int(os.environ.get("JCSRV_CHUNKMAXAGE", "31536000"))
+# let a front web server (nginx X-Accel, lighttpd) do the sendfile
+app.config["USE_X_SENDFILE"] = os.environ.get("JCSRV_XSENDFILE", "") == "1"
+SYNCMARGIN = int(os.environ.get("JCSRV_SYNCMARGIN", "60"))
+JOURNALMAX = int(os.environ.get("JCSRV_JOURNALMAX", "1000"))
+JOURNALCOMPACT = float(os.environ.get("JCSRV_JOURNALCOMPACT", "60"))
+REPLDIR = f"{SHARE}/{hostname}/replication"
+SERVER = os.environ.get("JCSRV_SERVER", "waitress")
+PORT = int(os.environ.get("JCSRV_PORT", "5000"))
+SRVTHREADS = int(os.environ.get("JCSRV_SRVTHREADS", "16"))
+SRVCONNLIMIT = int(os.environ.get("JCSRV_SRVCONNLIMIT", "256"))
+SRVIDLETIMEOUT = int(os.environ.get("JCSRV_SRVIDLETIMEOUT", "30"))
+SRVSTOPTIMEOUT = float(os.environ.get("JCSRV_SRVSTOPTIMEOUT", "5.0"))
+stopping = threading.Event()
+RECBACKOFFMIN = float(os.environ.get("JCSRV_RECBACKOFFMIN", "0.5"))
+RECBACKOFFMAX = float(os.environ.get("JCSRV_RECBACKOFFMAX", "30"))
+RECBACKOFFRESET = float(os.environ.get("JCSRV_RECBACKOFFRESET", "60"))
+RECPOLL = float(os.environ.get("JCSRV_RECPOLL", "0.5"))
+METRICSBUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+DELWORKERS = int(os.environ.get("JCSRV_DELWORKERS", "4"))
+DELJOBSMAX = int(os.environ.get("JCSRV_DELJOBSMAX", "50"))
+IOPRIO_SET = dict(x86_64=251, i386=289, i686=289, aarch64=30, armv7l=314, riscv64=30)
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+EVENTSMAX = int(os.environ.get("JCSRV_EVENTSMAX", "10000"))
+EVENTSKEEPALIVE = float(os.environ.get("JCSRV_EVENTSKEEPALIVE", "15"))
+# every event stream holds one waitress thread for its lifetime: the pool is SRVTHREADS request
+# workers plus EVENTSCLIENTS stream threads, size it for all screens (hall displays, referee UIs)
+EVENTSCLIENTS = int(os.environ.get("JCSRV_EVENTSCLIENTS", "64"))
+REPLBACKOFFMAX = float(os.environ.get("JCSRV_REPLBACKOFFMAX", "5.0"))
+# queues of peers out of the cluster are kept this long/this many entries, the peer pulls the
+# rest by resync when it joins again
+REPLKEEP = float(os.environ.get("JCSRV_REPLKEEP", "3600"))
+REPLMAX = int(os.environ.get("JCSRV_REPLMAX", "10000"))
+RESTPREFIX = os.environ.get("JCSRV_RESTPREFIX", "http://srv%d:5000/api/v1")
 RESTURIRECORDING = RESTPREFIX + "/recording"
 RESTURIRECORDINGCAM = RESTPREFIX + "/recording/%d"
 RESTURICAMS = RESTPREFIX + "/cams"
@@ -72,10 +192,16 @@ RESTURICAMSDATE = RESTPREFIX + "/cams/%s"
 RESTURICAMSDATECAM = RESTPREFIX + "/cams/%s/%d"
 RESTURICHUNKSDATE = RESTPREFIX + "/chunks/%s"
 RESTURICHUNKSDATECAM = RESTPREFIX + "/chunks/%s/%d"
+RESTURICHUNKSDATECAMCHUNK = RESTPREFIX + "/chunks/%s/%d/%s"
 RESTURIPLAYERS = RESTPREFIX + "/players"
 RESTURIPLAYERSPLAYER = RESTPREFIX + "/players/%d"
 RESTURIMATSDATE = RESTPREFIX + "/mats/%s"
 RESTURIMATSDATEMAT = RESTPREFIX + "/mats/%s/%d"
+RESTURIMATSDATEMATKIND = RESTPREFIX + "/mats/%s/%d/%s"
+RESTURIMATSDATEMATITEM = RESTPREFIX + "/mats/%s/%d/%s/%s"
+MATKINDS = ["bookmarks", "medicals"]
+RESTURISYNC = RESTPREFIX + "/sync?cams=%d&players=%d&mats=%d"
+RESTURISYNCPULL = RESTPREFIX + "/sync"
 
 
 def get_linenumber():
@@ -83,224 +209,1226 @@ def get_linenumber():
     return cf.f_back.f_lineno
 
 
+class MetricRegistry:
+    # labelled counters and histograms rendered in the prometheus text format at /metrics
+    HELP = dict(
+        jcsrv_live_cycle_seconds=("histogram", "live_thread sweep duration"),
+        jcsrv_lock_wait_seconds=("histogram", "time waiting for a lock"),
+        jcsrv_lock_hold_seconds=("histogram", "time a lock is held"),
+        jcsrv_rpc_seconds=("histogram", "peer RPC latency per attempt"),
+        jcsrv_rpc_errors_total=("counter", "failed peer RPC attempts"),
+        jcsrv_rpc_retries_total=("counter", "retried peer RPC attempts"),
+        jcsrv_sync_seconds=("histogram", "config resync duration"),
+        jcsrv_sync_total=("counter", "config resyncs by result"),
+        jcsrv_recorder_restarts_total=("counter", "CAMEXEC restarts after exit"),
+        jcsrv_http_request_seconds=("histogram", "request latency per endpoint"),
+        jcsrv_chunk_rescans_total=("counter", "chunk directory rescans"),
+        jcsrv_chunks_created_total=("counter", "chunks created by local recorders"),
+        jcsrv_chunk_downloads_total=("counter", "chunk downloads by result"),
+        jcsrv_chunks=("gauge", "chunks of today per camera"),
+        jcsrv_recorders_running=("gauge", "running CAMEXEC children"),
+        jcsrv_members_alive=("gauge", "alive servers in membership"),
+        jcsrv_event_clients=("gauge", "connected event stream clients"),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(METRICSBUCKETS, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # bucket counts, sum, count
+                histogram = self.histograms[key] = [0] * len(METRICSBUCKETS) + [0.0, 0]
+            if i < len(METRICSBUCKETS):
+                histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def labels(self, labels, **extra):
+        labels = list(labels) + list(extra.items())
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+    def render(self, gauges):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(histogram) for key, histogram in self.histograms.items()}
+        samples = {}
+        for (name, labels), value in list(counters.items()) + [((name, tuple(sorted(labels.items()))), value) for name, labels, value in gauges]:
+            samples.setdefault(name, []).append(f"{name}{self.labels(labels)} {value}")
+        for (name, labels), histogram in histograms.items():
+            cumulative = 0
+            for le, count in zip(METRICSBUCKETS, histogram):
+                cumulative += count
+                samples.setdefault(name, []).append(f"{name}_bucket{self.labels(labels, le=le)} {cumulative}")
+            samples[name].append(f"{name}_bucket{self.labels(labels, le='+Inf')} {histogram[-1]}")
+            samples[name].append(f"{name}_sum{self.labels(labels)} {histogram[-2]}")
+            samples[name].append(f"{name}_count{self.labels(labels)} {histogram[-1]}")
+        lines = []
+        for name in sorted(samples):
+            kind, text = self.HELP.get(name, ("untyped", name))
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"] + samples[name]
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricRegistry()
+
+
+class TimedLock:
+    # threading.Lock that records wait and hold times
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.acquired = time.perf_counter()
+        metrics.observe("jcsrv_lock_wait_seconds", self.acquired - start, lock=self.name)
+        return True
+
+    def release(self):
+        metrics.observe("jcsrv_lock_hold_seconds", time.perf_counter() - self.acquired, lock=self.name)
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+lock = TimedLock("global")
+
+
+class Store:
+    # copy-on-write state of one domain: readers take get() or snapshot() without any lock, writers
+    # hold self.lock, build the next version sharing unchanged parts and publish it with swap();
+    # (version, data) is published as one tuple, an ETag always matches the body it is sent with
+    def __init__(self, data):
+        self.current = (0, data)
+        self.lock = threading.RLock()
+
+    def get(self):
+        return self.current[1]
+
+    def snapshot(self):
+        return self.current
+
+    @property
+    def version(self):
+        return self.current[0]
+
+    def swap(self, data):
+        self.current = (self.current[0] + 1, data)
+
+
+cfgstore = Store({today: {}})
+playerstore = Store({})
+matstore = Store({})
+stores = dict(cams=cfgstore, players=playerstore, mats=matstore)
+
+
+class EventLog:
+    # numbered ring of typed state changes streamed by /api/v1/events, ids are "<BOOTID>-<seq>"
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.ring = collections.deque(maxlen=EVENTSMAX)
+        self.seq = 0
+        self.owners = {}
+        self.clients = 0
+
+    def publish(self, kind, data):
+        with self.cond:
+            self.seq += 1
+            self.ring.append((self.seq, kind, data))
+            self.cond.notify_all()
+
+    def since(self, seq, timeout):
+        # (seq, events after seq) or (current seq, None) when seq already left the ring
+        with self.cond:
+            if seq == self.seq:
+                self.cond.wait(timeout)
+            if seq < self.seq - len(self.ring) or seq > self.seq:
+                return self.seq, None
+            return self.seq, list(itertools.islice(self.ring, len(self.ring) - (self.seq - seq), None))
+
+    def stream(self, seq):
+        with self.cond:
+            self.clients += 1
+        try:
+            while not stopping.is_set():
+                seq, batch = self.since(seq, EVENTSKEEPALIVE)
+                if batch is None:
+                    # resume point lost, client reloads the full state
+                    yield f"id: {BOOTID}-{seq}\nevent: reset\ndata: {{}}\n\n"
+                elif not batch:
+                    yield ": keepalive\n\n"
+                else:
+                    yield "".join(f"id: {BOOTID}-{_seq}\nevent: {kind}\ndata: {json.dumps(data)}\n\n" for _seq, kind, data in batch)
+        finally:
+            with self.cond:
+                self.clients -= 1
+
+
+events = EventLog()
+
+
+class PeerClient:
+    # keep-alive session per peer, per-call deadline, retries with backoff, latency/error counters
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.stats = {}
+        self.etags = collections.OrderedDict()
+        self.etagsize = 0
+
+    def session(self, srvid):
+        with self.lock:
+            if srvid not in self.sessions:
+                session = requests.Session()
+                session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=RPCPOOLSIZE, max_retries=0))
+                session.headers["X-JC-Srvid"] = str(srvid_own)
+                if PEERKEY:
+                    session.auth = signrequest
+                self.sessions[srvid] = session
+                self.stats.setdefault(srvid, dict(requests=0, errors=0, retries=0, latency=0.0, latency_max=0.0))
+            return self.sessions[srvid]
+
+    def close(self, srvid):
+        with self.lock:
+            session = self.sessions.pop(srvid, None)
+        if session:
+            session.close()
+
+    def account(self, srvid, latency, error=False, retry=False):
+        metrics.observe("jcsrv_rpc_seconds", latency, srvid=srvid)
+        if error:
+            metrics.inc("jcsrv_rpc_errors_total", srvid=srvid)
+        if retry:
+            metrics.inc("jcsrv_rpc_retries_total", srvid=srvid)
+        with self.lock:
+            stats = self.stats[srvid]
+            stats["requests"] += 1
+            stats["errors"] += error
+            stats["retries"] += retry
+            stats["latency"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+
+    def request(self, method, srvid, uri, *args, timeout=RPCTIMEOUT, retries=RPCRETRIES, **kwargs):
+        url = uri % ((srvid,) + args)
+        session = self.session(srvid)
+        deadline = time.time() + timeout
+        backoff = RPCBACKOFF
+        retry = False
+        while True:
+            start = time.time()
+            try:
+                response = session.request(method, url, timeout=max(deadline - start, 0.001), **kwargs)
+                self.account(srvid, time.time() - start, retry=retry)
+                return response
+            except requests.RequestException:
+                self.account(srvid, time.time() - start, error=True, retry=retry)
+                if retries <= 0 or time.time() + backoff >= deadline:
+                    raise
+            retries -= 1
+            retry = True
+            time.sleep(backoff)
+            backoff *= 2
+
+    def get(self, srvid, uri, *args, **kwargs):
+        return self.request("GET", srvid, uri, *args, **kwargs)
+
+    def getraw(self, srvid, uri, *args, cache=True, **kwargs):
+        # conditional GET, unchanged documents come back as 304 and are served from the cached body,
+        # LRU bounded by RPCCACHEMAX bytes of bodies
+        url = uri % ((srvid,) + args)
+        with self.lock:
+            cached = self.etags.get(url) if cache else None
+            if cached:
+                self.etags.move_to_end(url)
+        response = self.get(srvid, uri, *args, headers={"If-None-Match": cached[0]} if cached else {}, **kwargs)
+        if response.status_code == 304 and cached:
+            return cached[1]
+        if response.status_code != 200:
+            # error bodies ({"message": ...}) are never taken for documents
+            raise requests.HTTPError(f"{response.status_code} {url}", response=response)
+        if cache and response.status_code == 200 and "ETag" in response.headers:
+            with self.lock:
+                old = self.etags.pop(url, None)
+                self.etagsize -= len(old[1]) if old else 0
+                if len(response.content) <= RPCCACHEMAX:
+                    self.etags[url] = (response.headers["ETag"], response.content)
+                    self.etagsize += len(response.content)
+                while self.etagsize > RPCCACHEMAX:
+                    self.etagsize -= len(self.etags.popitem(last=False)[1][1])
+        return response.content
+
+    def getjson(self, srvid, uri, *args, **kwargs):
+        # identical concurrent lookups share one request, every caller gets its own parsed copy;
+        # cache=False for documents not worth an ETag entry (unique URLs, cached elsewhere)
+        return json.loads(rpcflight.do(uri % ((srvid,) + args), self.getraw, srvid, uri, *args, **kwargs))
+
+    def put(self, srvid, uri, *args, **kwargs):
+        return self.request("PUT", srvid, uri, *args, **kwargs)
+
+    def post(self, srvid, uri, *args, **kwargs):
+        return self.request("POST", srvid, uri, *args, **kwargs)
+
+    def patch(self, srvid, uri, *args, **kwargs):
+        return self.request("PATCH", srvid, uri, *args, **kwargs)
+
+    def delete(self, srvid, uri, *args, **kwargs):
+        return self.request("DELETE", srvid, uri, *args, **kwargs)
+
+
+class SingleFlight:
+    # identical concurrent calls share one execution, the result is reused for ttl seconds
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        now = time.time()
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None or (call["event"].is_set() and now - call["ts"] > self.ttl)
+            if leader:
+                call = self.calls[key] = dict(event=threading.Event(), result=None, error=None, ts=now)
+        if leader:
+            try:
+                call["result"] = fn(*args, **kwargs)
+            except Exception as e:
+                call["error"] = e
+            with self.lock:
+                call["ts"] = time.time()
+                if call["error"] or not self.ttl:
+                    self.calls.pop(key, None)
+                for _key in [_key for _key, _call in self.calls.items() if _call["event"].is_set() and call["ts"] - _call["ts"] > self.ttl]:
+                    del self.calls[_key]
+            call["event"].set()
+        else:
+            call["event"].wait()
+        if call["error"]:
+            raise call["error"]
+        return call["result"]
+
+
+peerclient = PeerClient()
+rpcflight = SingleFlight(COALESCETTL)
+chunksflight = SingleFlight(COALESCETTL)
+rpcexecutor = concurrent.futures.ThreadPoolExecutor(max_workers=RPCWORKERS)
+# lease rounds never queue behind chunk fan-out
+leaseexecutor = concurrent.futures.ThreadPoolExecutor(max_workers=LEASEWORKERS)
+
+
+class Replicator:
+    # durable per-peer queues of writes, drained in order by one worker per peer, kept while the
+    # peer is out of the cluster (bounded by REPLKEEP/REPLMAX); file appends are group committed
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.stats = {}
+        self.seq = 0
+        self.ops = {}
+        self.opseq = 0
+        self.synced = 0
+
+    def path(self, srvid):
+        return f"{REPLDIR}/srv{srvid}.jsonl"
+
+    def load(self):
+        if not os.path.exists(REPLDIR):
+            os.makedirs(REPLDIR, mode=0o755)
+        for name in [name for name in os.listdir(REPLDIR) if re.fullmatch(r'^srv\d+\.jsonl$', name)]:
+            srvid = int(name[3:-6])
+            entries = {}
+            with open(f"{REPLDIR}/{name}", "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn last write
+                        break
+                    if "ack" in entry:
+                        entries.pop(entry["ack"], None)
+                    else:
+                        entries[entry["seq"]] = entry
+            with self.cond:
+                for seq in sorted(entries.keys()):
+                    self.seq = max(self.seq, seq)
+                    self.enqueue(srvid, entries[seq])
+            print(f"srv.py: replication srv{srvid} {len(entries)} pending")
+        threading.Thread(target=self.flush_thread, daemon=True).start()
+
+    def write(self, srvid, entry):
+        # caller holds self.cond, durable once self.synced reaches the returned ticket
+        self.ops.setdefault(srvid, []).append(json.dumps(entry, separators=(',', ':')))
+        self.opseq += 1
+        self.cond.notify_all()
+        return self.opseq
+
+    def truncate(self, srvid):
+        self.ops.setdefault(srvid, []).append(None)
+        self.opseq += 1
+        self.cond.notify_all()
+
+    def flush_thread(self):
+        print("REPLICATION thread start")
+        while True:
+            with self.cond:
+                while not self.ops:
+                    self.cond.wait()
+                ops, self.ops = self.ops, {}
+                seq = self.opseq
+            for srvid, lines in ops.items():
+                # one write and fsync per peer and batch, a truncate drops what came before it
+                mode = "a"
+                if None in lines:
+                    lines, mode = lines[len(lines) - lines[::-1].index(None):], "w"
+                try:
+                    with open(self.path(srvid), mode) as f:
+                        if lines:
+                            f.write("\n".join(lines) + "\n")
+                        f.flush()
+                        os.fsync(f.fileno())
+                except OSError as e:
+                    print(f"srv.py: replication write failed srv{srvid} {e}")
+            with self.cond:
+                self.synced = seq
+                self.cond.notify_all()
+
+    def prune(self):
+        now = time.time()
+        for srvid, queue in self.queues.items():
+            dropped = 0
+            while queue and (len(queue) > REPLMAX or now - queue[0]["ts"] > REPLKEEP):
+                self.write(srvid, dict(ack=queue.pop(0)["seq"]))
+                dropped += 1
+            if dropped and not queue:
+                self.truncate(srvid)
+            if dropped:
+                print(f"srv.py: replication srv{srvid} dropped {dropped} old, left to resync")
+
+    def enqueue(self, srvid, entry):
+        if srvid not in self.queues:
+            self.queues[srvid] = []
+            self.stats[srvid] = dict(sent=0, errors=0, last=None)
+            threading.Thread(target=self.worker, args=(srvid,), daemon=True).start()
+        self.queues[srvid].append(entry)
+        self.cond.notify_all()
+
+    def push(self, method, uri, *args, json=None):
+        with lock:
+            _srvs = set(srvs.keys())
+        with self.cond:
+            # peers out of the cluster keep queueing, sent when they join again
+            _srvs |= set(self.queues.keys())
+            self.seq += 1
+            entry = dict(seq=self.seq, ts=time.time(), method=method, uri=uri, args=args, json=json)
+            ticket = 0
+            for srvid in _srvs:
+                ticket = self.write(srvid, entry)
+                self.enqueue(srvid, entry)
+            self.prune()
+            while self.synced < ticket:
+                self.cond.wait()
+
+    def worker(self, srvid):
+        backoff = RPCBACKOFF
+        while True:
+            with self.cond:
+                while not self.queues[srvid] or srvid not in srvs:
+                    self.cond.wait(timeout=1)
+                entry = self.queues[srvid][0]
+            try:
+                response = peerclient.request(entry["method"], srvid, entry["uri"], *entry["args"], json=entry["json"])
+                if response.status_code >= 500:
+                    raise Exception(f"status {response.status_code}")
+            except:
+                print("srv.py: conn error", get_linenumber())
+                with self.cond:
+                    self.stats[srvid]["errors"] += 1
+                time.sleep(backoff)
+                backoff = min(backoff * 2, REPLBACKOFFMAX)
+                continue
+            backoff = RPCBACKOFF
+            with self.cond:
+                self.stats[srvid]["sent"] += 1
+                self.stats[srvid]["last"] = time.time()
+                if self.queues[srvid] and self.queues[srvid][0] is entry:
+                    self.queues[srvid].pop(0)
+                    if self.queues[srvid]:
+                        self.write(srvid, dict(ack=entry["seq"]))
+                    else:
+                        self.truncate(srvid)
+
+    def status(self):
+        now = time.time()
+        with self.cond:
+            return {srvid: dict(pending=len(queue), lag=now - queue[0]["ts"] if queue else 0.0, **self.stats[srvid])
+                    for srvid, queue in self.queues.items()}
+
+
+replicator = Replicator()
+
+
+def peersig(srvid, method, path, ts, nonce):
+    return hmac.new(PEERKEY.encode(), f"{srvid} {method} {path} {ts} {nonce}".encode(), hashlib.sha256).hexdigest()
+
+
+def signrequest(prepared):
+    # requests auth hook: every peer request (retries too) is signed over method, path and time
+    ts, nonce = int(time.time()), os.urandom(8).hex()
+    prepared.headers["X-JC-Peersig"] = f"{ts}:{nonce}:{peersig(srvid_own, prepared.method, prepared.path_url, ts, nonce)}"
+    return prepared
+
+
+class PeerIds:
+    # address -> is a srvN peer by reverse DNS, cached for PEERIDTTL, resolved and refreshed in the
+    # background only (a new address is no peer until then, request threads never wait on DNS);
+    # nonces of signatures seen within PEERSIGWINDOW, a replayed signature is refused
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.queued = set()
+        self.pending = queue.Queue()
+        self.nonces = set()
+        self.expiry = collections.deque()
+
+    def lookup(self, addr):
+        with self.lock:
+            entry = self.cache.get(addr)
+            if (not entry or entry[0] < time.time()) and addr not in self.queued:
+                self.queued.add(addr)
+                self.pending.put(addr)
+        return entry[1] if entry else False
+
+    def resolve(self, addr):
+        try:
+            peer = socket.gethostbyaddr(addr)[0].startswith("srv")
+        except OSError:
+            peer = False
+        with self.lock:
+            self.cache[addr] = (time.time() + PEERIDTTL, peer)
+            self.queued.discard(addr)
+        return peer
+
+    def verify(self, srvid, sig, method, path):
+        try:
+            ts, nonce, mac = sig.split(":")
+            ts = int(ts)
+        except ValueError:
+            return False
+        now = time.time()
+        if abs(now - ts) > PEERSIGWINDOW or not hmac.compare_digest(mac, peersig(srvid, method, path, ts, nonce)):
+            return False
+        with self.lock:
+            while self.expiry and self.expiry[0][0] < now:
+                self.nonces.discard(self.expiry.popleft()[1])
+            if nonce in self.nonces:
+                return False
+            self.nonces.add(nonce)
+            self.expiry.append((now + 2 * PEERSIGWINDOW, nonce))
+        return True
+
+    def run(self):
+        while True:
+            self.resolve(self.pending.get())
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+
+peerids = PeerIds()
+
+
+def from_srv():
+    # peers send X-JC-Srvid: with JCSRV_PEERKEY only a fresh signature counts, else they are told by
+    # heartbeat address in the membership table or by the cached reverse DNS, on loopback with
+    # JCSRV_SIMULATION by X-JC-Srvid alone; once per request
+    if "jcsrv.fromsrv" not in request.environ:
+        path = request.path + ("?" + request.query_string.decode() if request.query_string else "")
+        request.environ["jcsrv.fromsrv"] = identify(request.remote_addr, request.headers.get("X-JC-Srvid"), request.headers.get("X-JC-Peersig"),
+                                                    request.method, path)
+    return request.environ["jcsrv.fromsrv"]
+
+
+def identify(addr, srvid, sig, method, path):
+    if not srvid:
+        return False
+    if PEERKEY:
+        return bool(sig) and peerids.verify(srvid, sig, method, path)
+    if SIMULATION and ipaddress.ip_address(addr).is_loopback:
+        return True
+    with memberslock:
+        if any(member.get("addr") == addr for member in members.values()):
+            return True
+    return peerids.lookup(addr)
+
+
+def conditional(data, tag, headers=None):
+    # answer 304 when the client already holds this version
+    headers = dict(headers or {}, ETag=f'"{tag}"')
+    if request.if_none_match.contains(tag):
+        return '', 304, headers
+    return data, 200, headers
+
+
+def versiontag(domain, version):
+    return f"{domain}-{srvid_own}-{BOOTID}-{version}"
+
+
+def contenttag(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def replaced(data, key, value):
+    # shallow copy with one entry replaced (or removed for None), unchanged parts stay shared
+    data = dict(data)
+    if value is None:
+        data.pop(key, None)
+    else:
+        data[key] = value
+    return data
+
+
+class Journal:
+    # append-only per day log of changed cams/players/mats entries with group commit (one fsync
+    # per batch), compacted into the cams.cfg/players.cfg/mats.cfg snapshots in the background
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.iolock = threading.Lock()
+        self.pending = []
+        self.seq = 0
+        self.synced = 0
+        self.counts = {}
+        self.domains = {}
+        self.compacted = {}
+        self.failed = {}
+        self.edited = set()
+
+    def path(self, day):
+        return f"{SHARE}/{hostname}/{day}/journal.log"
+
+    def append(self, day, domain, records, edit=False):
+        # caller holds the store lock, so records hit the log in swap order; edit: operator change,
+        # the next compaction keeps a backup of the snapshot
+        if not records:
+            return 0
+        with self.cond:
+            for key, value in records:
+                self.seq += 1
+                self.pending.append((self.seq, day, domain, json.dumps(dict(d=domain, k=key, v=value), separators=(',', ':'))))
+            if edit:
+                self.edited.add((day, domain))
+            self.cond.notify_all()
+            return self.seq
+
+    def wait(self, ticket):
+        # durable after return, raises the OSError of a failed write; called without any store lock
+        # to let commits group
+        with self.cond:
+            while self.synced < ticket:
+                self.cond.wait()
+            error = self.failed.pop(ticket, None)
+        if error:
+            raise error
+
+    def replay(self, day, domain):
+        records = []
+        if os.path.exists(self.path(day)):
+            with open(self.path(day), "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn last write
+                        break
+                    if record["d"] == domain:
+                        records.append((record["k"], record["v"]))
+        return records
+
+    def flush_thread(self):
+        print("JOURNAL thread start")
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                pending, self.pending = self.pending, []
+                seq = self.seq
+            days = {}
+            for lineseq, day, domain, line in pending:
+                days.setdefault(day, []).append((lineseq, line))
+                self.domains.setdefault(day, set()).add(domain)
+            failed = {}
+            with self.iolock:
+                for day, lines in days.items():
+                    try:
+                        with open(self.path(day), "a") as f:
+                            f.write("\n".join(line for _, line in lines) + "\n")
+                            f.flush()
+                            os.fsync(f.fileno())
+                    except OSError as e:
+                        print(f"srv.py: journal write failed {day} {e}")
+                        failed.update((lineseq, e) for lineseq, _ in lines)
+                        continue
+                    self.counts[day] = self.counts.get(day, 0) + len(lines)
+            with self.cond:
+                if failed:
+                    # the waiter of a ticket takes its error, left over ones are long stale after JOURNALMAX
+                    self.failed = {lineseq: e for lineseq, e in self.failed.items() if lineseq > seq - JOURNALMAX}
+                    self.failed.update(failed)
+                self.synced = seq
+                self.cond.notify_all()
+
+    def compact(self, day, domains=("cams", "players", "mats")):
+        # snapshot under all store locks (fixed order, writers hold only one), then truncate the log
+        with cfgstore.lock, playerstore.lock, matstore.lock:
+            if day == today and "cams" in domains:
+                with self.cond:
+                    backup = (day, "cams") in self.edited
+                    self.edited.discard((day, "cams"))
+                savecfg(backup=backup)
+            if day == today and "players" in domains:
+                saveplayers()
+            if day in matstore.get() and "mats" in domains:
+                savemats(day)
+            with self.iolock:
+                if os.path.exists(self.path(day)):
+                    open(self.path(day), "w").close()
+                self.counts[day] = 0
+                self.domains[day] = set()
+
+    def forget(self, day):
+        # deleted day, nothing left to compact
+        with self.iolock:
+            self.counts.pop(day, None)
+            self.domains.pop(day, None)
+            self.compacted.pop(day, None)
+
+    def compact_thread(self):
+        print("COMPACT thread start")
+        while True:
+            time.sleep(JOURNALCOMPACT / 10)
+            with self.iolock:
+                days = [(day, set(self.domains[day])) for day, count in self.counts.items() if count >= JOURNALMAX or (count and time.time() - self.compacted.get(day, 0) > JOURNALCOMPACT)]
+            for day, domains in days:
+                self.compact(day, domains)
+                self.compacted[day] = time.time()
+
+    def start(self):
+        for day in [day for day in os.listdir(f"{SHARE}/{hostname}/") if re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', day) and os.path.exists(self.path(day))]:
+            # replayed by the loaders, fold it into the snapshots now
+            pastdays.ensure(day)
+            self.compact(day)
+        threading.Thread(target=self.flush_thread, daemon=True).start()
+        threading.Thread(target=self.compact_thread, daemon=True).start()
+
+
+journal = Journal()
+
+
+def commit(day, domain, old, new, edit=False):
+    # publish and journal the entries that differ between two copy-on-write versions
+    records = [(key, new.get(key)) for key in set(old) | set(new) if old.get(key) is not new.get(key)]
+    for key, value in records:
+        events.publish(domain, dict(day=day, id=key, value=value))
+    if domain == "mats" and day not in cfgslocal:
+        return 0
+    return journal.append(day, domain, records, edit)
+
+
+def publishleases():
+    # caller holds lock, the heartbeat reads the published tuple without it
+    global leases
+    leases = ({str(camid): cam["epoch"] for camid, cam in cams.items() if cam["srvid"] == srvid_own and cam["state"] == "owned"},
+              {str(camid): handover["srvid"] for camid, handover in handovers.items() if handover["released"]})
+
+
+def publishowners():
+    # owner changes of recorded cams since the last call
+    with lock:
+        owners = {camid: cam["srvid"] for camid, cam in cams.items()}
+    with events.cond:
+        for camid in set(owners) | set(events.owners):
+            if owners.get(camid) != events.owners.get(camid):
+                events.publish("owner", dict(camid=camid, srvid=owners.get(camid)))
+        events.owners = owners
+
+
+def markretry(srvid):
+    with lock:
+        if srvid in srvs:
+            srvs[srvid]["retry"] = True
+
+
+def savejson(path, data, backup=False):
+    # snapshot: fsynced temp file atomically replaces the old one, an unchanged snapshot is not
+    # rewritten, backup keeps a copy of the previous one (the live file is never missing)
+    if not os.path.exists(os.path.dirname(path)):
+        os.mkdir(os.path.dirname(path), mode=0o755)
+    text = json.dumps(data, indent=4)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            if f.read() == text:
+                return
+        if backup:
+            shutil.copy2(path, path+'_' + str(int(time.time())))
+    with open(path + "_", "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + "_", path)
+    dirfd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
 def savemats(day, backup=False):
-    global cfgslocal, mats
-    if not lock.locked():
-        print("ERR not locked\n")
     if day not in cfgslocal:
         return
-    matsfile = f"/share/{hostname}/{day}/mats.cfg"
-    if not os.path.exists(os.path.dirname(matsfile)):
-        os.mkdir(os.path.dirname(matsfile), mode=0o755)
-    with open(matsfile + "_", "w") as f:
-        json.dump(mats[day], f, indent=4)
+    matsfile = f"{SHARE}/{hostname}/{day}/mats.cfg"
+    savejson(matsfile, matstore.get()[day], backup)
+
+
+def readmats(day):
+    daymats = {}
+    for matid in [str(matid) for matid in range(1, MAXMAT+1)]:
+        daymats[matid] = dict(bookmarks=[], medicals=[])
+    matsfile = f"{SHARE}/{hostname}/{day}/mats.cfg"
     if os.path.exists(matsfile):
-        if backup:
-            os.rename(matsfile, matsfile+'_' + str(int(time.time())))
+        with open(matsfile, "r") as f:
+            try:
+                daymats = json.load(f)
+            except:
+                print(f"srv.py: mats json failed {matsfile}")
+    for key, value in journal.replay(day, "mats"):
+        if "/" in key:
+            matid, kind = key.split("/")
+            daymats[matid] = applyitem(daymats[matid], kind, value)
         else:
-            os.remove(matsfile)
-    os.rename(matsfile+'_', matsfile)
+            daymats[key] = value
+    return daymats
 
 
 def loadmats():
-    global cfgs, mats, srvs
-    if not lock.locked():
-        print("ERR not locked\n")
-    srvdays = {}
-    for day in cfgs.keys():
-        daymats = {}
-        for matid in [str(matid) for matid in range(1, MAXMAT+1)]:
-            daymats[matid] = dict(bookmarks=[], medicals=[])
-        matsfile = f"/share/{hostname}/{day}/mats.cfg"
-        if os.path.exists(matsfile):
-            with open(matsfile, "r") as f:
-                try:
-                    daymats = json.load(f)
-                except:
-                    print(f"srv.py: mats json failed {matsfile}")
+    # today only, past days come with pastdays.ensure()
+    days = list(cfgstore.get().keys())
+    with matstore.lock:
+        matstore.swap({day: readmats(day) for day in days})
+        for day in days:
+            savemats(day)
+
+
+def itemorder(item):
+    # equal timestamps from two servers resolve the same way everywhere
+    return (item["ts"], json.dumps(item, sort_keys=True))
+
+
+def applyitem(mat, kind, item):
+    # last writer wins per item "id", a tombstone is an item with "deleted", the mat itself
+    # is returned unchanged for a stale item
+    items = mat.get(kind, [])
+    tombstones = mat.get("tombstones", {})
+    old = [_item for _item in items if _item.get("id") == item["id"]]
+    if old and "ts" in old[0] and itemorder(old[0]) >= itemorder(item):
+        return mat
+    if tombstones.get(item["id"], -1) >= item["ts"]:
+        return mat
+    mat = dict(mat, ts=max(mat.get("ts", 0), item["ts"] // 1000))
+    if item.get("deleted"):
+        mat["tombstones"] = replaced(tombstones, item["id"], item["ts"])
+        for _kind in MATKINDS:
+            mat[_kind] = [_item for _item in mat.get(_kind, []) if _item.get("id") != item["id"]]
+    elif old:
+        mat[kind] = [item if _item.get("id") == item["id"] else _item for _item in items]
+    else:
+        mat[kind] = items + [item]
+    return mat
+
+
+def mergemat(mat, remote):
+    # newer "ts" wins for the whole mat, items with "id" and tombstones of the other side are merged in
+    if "ts" in remote and ("ts" not in mat or remote["ts"] > mat["ts"]):
+        merged, other = remote, mat
+    else:
+        merged, other = mat, remote
+    for kind in MATKINDS:
+        for item in other.get(kind, []):
+            if "id" in item and "ts" in item:
+                merged = applyitem(merged, kind, item)
+    for itemid, ts in other.get("tombstones", {}).items():
+        merged = applyitem(merged, MATKINDS[0], dict(id=itemid, ts=ts, deleted=True))
+    return mat if merged == mat else merged
+
+
+def mergemats(mats, remote):
+    # remote {day: {matid: mat}}
+    mats = dict(mats)
+    for day, srvmats in remote.items():
+        if day not in mats:
+            mats[day] = {matid: dict(bookmarks=[], medicals=[]) for matid in [str(matid) for matid in range(1, MAXMAT+1)]}
+        daymats = dict(mats[day])
+        for matid, mat in srvmats.items():
+            if matid not in daymats:
+                daymats[matid] = mat
+            else:
+                daymats[matid] = mergemat(daymats[matid], mat)
         mats[day] = daymats
-        for srvid in srvs.keys():
-            try:
-                if "retry" not in srvs[srvid]:
-                    if srvid not in srvdays:
-                        srvdays[srvid] = requests.get(RESTURICAMS % (srvid), timeout=1).json()
-                    if day in srvdays[srvid]:
-                        daymats = requests.get(RESTURIMATSDATE % (srvid, day), timeout=1).json()
-                        for matid in [str(matid) for matid in range(1, MAXMAT+1)]:
-                            if matid not in mats[day]:
-                                mats[day][matid] = daymats[matid]
-                            else:
-                                if "ts" in daymats[matid] and ("ts" not in mats[day][matid] or daymats[matid]["ts"] > mats[day][matid]["ts"]):
-                                    mats[day][matid] = daymats[matid]
-            except:
-                print("srv.py: conn error", get_linenumber())
-                srvs[srvid]["retry"] = True
-        savemats(day)
+    return mats
 
 
 class Mats(Resource):
     def get(self, day=None, matid=None):
-        global mats
-        with lock:
-            if matid:
-                if 1 <= matid <= MAXMAT and day in mats:
-                    return mats[day][str(matid)]
-            else:
-                if day in mats:
-                    return mats[day]
+        if not pastdays.ensure(day):
+            abort(404, message="bad params")
+        version, mats = matstore.snapshot()
+        if matid:
+            if 1 <= matid <= MAXMAT and day in mats:
+                return conditional(mats[day][str(matid)], versiontag("mats", version))
+        else:
+            if day in mats:
+                return conditional(mats[day], versiontag("mats", version))
         abort(404, message="bad params")
 
     def patch(self, day=None, matid=None):
-        global mats, srvs
-        if matid and day in mats:
+        if matid and pastdays.ensure(day) and day in matstore.get():
             args = parser_mat.parse_args()
-            if not socket.gethostbyaddr(request.remote_addr)[0].startswith("srv"):
+            if not from_srv():
                 args["ts"] = int(time.time())
-            with lock:
-                for key in ["medicals", "bookmarks", "ts"]:
+            with matstore.lock:
+                mats = matstore.get()
+                mat = dict(mats[day][str(matid)])
+                for key in MATKINDS:
                     if key in args and args[key] != None:
-                        mats[day][str(matid)][key] = args[key]
-                savemats(day)
-            if not socket.gethostbyaddr(request.remote_addr)[0].startswith("srv"):
-                with lock:
-                    _srvs = list(srvs.keys())
-                for srvid in _srvs:
-                    try:
-                        requests.patch(RESTURIMATSDATEMAT % (srvid, day, matid), json=args, timeout=1)
-                    except:
-                        print("srv.py: conn error", get_linenumber())
+                        # items with "id" left out of the new list are deleted, not resurrected by a merge
+                        kept = set(item.get("id") for item in args[key])
+                        for item in mat.get(key, []):
+                            if "id" in item and item["id"] not in kept:
+                                mat["tombstones"] = replaced(mat.get("tombstones", {}), item["id"], (args["ts"] or 0) * 1000)
+                        mat[key] = args[key]
+                if args["ts"] != None:
+                    mat["ts"] = args["ts"]
+                matstore.swap(replaced(mats, day, replaced(mats[day], str(matid), mat)))
+                ticket = commit(day, "mats", mats[day], matstore.get()[day])
+            journal.wait(ticket)
+            if not from_srv():
+                replicator.push("PATCH", RESTURIMATSDATEMAT, day, matid, json=args)
+            return '', 204
+        abort(404, message="bad params")
+
+
+class MatItems(Resource):
+    def _apply(self, day, matid, kind, item):
+        with matstore.lock:
+            mats = matstore.get()
+            mat = applyitem(mats[day][str(matid)], kind, item)
+            if mat is mats[day][str(matid)]:
+                return
+            matstore.swap(replaced(mats, day, replaced(mats[day], str(matid), mat)))
+            events.publish("mats", dict(day=day, id=str(matid), value=mat))
+            ticket = journal.append(day, "mats", [(f"{matid}/{kind}", item)]) if day in cfgslocal else 0
+        journal.wait(ticket)
+
+    def post(self, day=None, matid=None, kind=None):
+        # add or update one bookmark/medical, answers the item with its "id" and "ts"
+        if matid and 1 <= matid <= MAXMAT and pastdays.ensure(day) and day in matstore.get() and kind in MATKINDS:
+            item = request.get_json(force=True, silent=True)
+            if not isinstance(item, dict):
+                abort(400, message="item must be a json object")
+            args = parser_matitem.parse_args()
+            item = dict(item)
+            item.pop("deleted", None)
+            local = not from_srv()
+            if local or not args["ts"]:
+                item["ts"] = int(time.time() * 1000)
+            if not args["id"]:
+                item["id"] = f"{srvid_own}-{os.urandom(6).hex()}"
+            elif not isinstance(item["id"], str) or not re.fullmatch(r'^[A-Za-z0-9._-]{1,64}$', item["id"]):
+                abort(400, message="bad item id")
+            self._apply(day, matid, kind, item)
+            if local:
+                replicator.push("POST", RESTURIMATSDATEMATKIND, day, matid, kind, json=item)
+            return item, 201
+        abort(404, message="bad params")
+
+    def delete(self, day=None, matid=None, kind=None, itemid=None):
+        if matid and 1 <= matid <= MAXMAT and pastdays.ensure(day) and day in matstore.get() and kind in MATKINDS and itemid and re.fullmatch(r'^[A-Za-z0-9._-]{1,64}$', itemid):
+            # the body with "ts" is sent by peers only, the UI deletes without one
+            body = request.get_json(force=True, silent=True)
+            ts = body.get("ts") if isinstance(body, dict) and isinstance(body.get("ts"), int) else None
+            local = not from_srv()
+            item = dict(id=itemid, ts=int(time.time() * 1000) if local or not ts else ts, deleted=True)
+            self._apply(day, matid, kind, item)
+            if local:
+                replicator.push("DELETE", RESTURIMATSDATEMATITEM, day, matid, kind, itemid, json=dict(ts=item["ts"]))
             return '', 204
         abort(404, message="bad params")
 
 
 def saveplayers(backup=False):
-    global players
-    if not lock.locked():
-        print("ERR not locked\n")
-    playersfile = f"/share/{hostname}/{today}/players.cfg"
-    if not os.path.exists(os.path.dirname(playersfile)):
-        os.mkdir(os.path.dirname(playersfile), mode=0o755)
-    with open(playersfile + "_", "w") as f:
-        json.dump(players, f, indent=4)
-    if os.path.exists(playersfile):
-        if backup:
-            os.rename(playersfile, playersfile+'_' + str(int(time.time())))
-        else:
-            os.remove(playersfile)
-    os.rename(playersfile+'_', playersfile)
+    playersfile = f"{SHARE}/{hostname}/{today}/players.cfg"
+    savejson(playersfile, playerstore.get(), backup)
 
 
 def loadplayers():
-    global players, srvs
-    if not lock.locked():
-        print("ERR not locked\n")
-    players = {}
-    playersfile = f"/share/{hostname}/{today}/players.cfg"
-    if os.path.exists(playersfile):
-        with open(playersfile, "r") as f:
-            try:
-                players = json.load(f)
-            except:
-                print(f"srv.py: players json failed {playersfile}")
-    for srvid in srvs.keys():
-        try:
-            for playerid in requests.get(RESTURIPLAYERS % (srvid), timeout=1).json():
-                playercfg = requests.get(RESTURIPLAYERSPLAYER % (srvid, int(playerid)), timeout=1).json()
-                if playerid not in players:
-                    players[playerid] = playercfg
-                else:
-                    if "ts" in playercfg and ("ts" not in players[playerid] or players[playerid]["ts"] > playercfg["ts"]):
-                        players[playerid] = playercfg
-        except:
-            print("srv.py: conn error", get_linenumber())
-            srvs[srvid]["retry"] = True
-    saveplayers()
+    with playerstore.lock:
+        players = {}
+        playersfile = f"{SHARE}/{hostname}/{today}/players.cfg"
+        if os.path.exists(playersfile):
+            with open(playersfile, "r") as f:
+                try:
+                    players = json.load(f)
+                except:
+                    print(f"srv.py: players json failed {playersfile}")
+        for playerid, player in journal.replay(today, "players"):
+            players[playerid] = player
+        playerstore.swap(players)
+        saveplayers()
+
+
+def mergeplayers(players, remote):
+    # remote {playerid: player}, kept "ts" rule: the older entry wins
+    players = dict(players)
+    for playerid, playercfg in remote.items():
+        if playerid not in players:
+            players[playerid] = playercfg
+        else:
+            if "ts" in playercfg and ("ts" not in players[playerid] or players[playerid]["ts"] > playercfg["ts"]):
+                players[playerid] = playercfg
+    return players
 
 
 class Players(Resource):
     def get(self, playerid=None):
-        global players
+        version, players = playerstore.snapshot()
         if playerid:
-            with lock:
-                if str(playerid) in players:
-                    return players[str(playerid)]
-                else:
-                    return {}
+            if str(playerid) in players:
+                return conditional(players[str(playerid)], versiontag("players", version))
+            else:
+                return {}
         else:
-            return list(players.keys())
+            return conditional(list(players.keys()), versiontag("players", version))
 
     def post(self, playerid=None):
-        global players, srvs
         if playerid:
             args = parser_player.parse_args()
-            if not socket.gethostbyaddr(request.remote_addr)[0].startswith("srv"):
+            if not from_srv():
                 args["ts"] = int(time.time())
-            with lock:
-                players[str(playerid)] = args
-                saveplayers()
-            if not socket.gethostbyaddr(request.remote_addr)[0].startswith("srv"):
-                with lock:
-                    _srvs = list(srvs.keys())
-                for srvid in _srvs:
-                    try:
-                        requests.post(RESTURIPLAYERSPLAYER % (srvid, playerid), json=args, timeout=1)
-                    except:
-                        print("srv.py: conn error", get_linenumber())
+            with playerstore.lock:
+                players = playerstore.get()
+                playerstore.swap(replaced(players, str(playerid), args))
+                ticket = commit(today, "players", players, playerstore.get())
+            journal.wait(ticket)
+            if not from_srv():
+                replicator.push("POST", RESTURIPLAYERSPLAYER, playerid, json=args)
             return '', 204
         abort(404, message="bad params")
 
 
 def add_srv(srvid):
-    global cfgs, srvs, cams, recording
+    global srvs, cams, recording
     if srvid not in srvs or "retry" in srvs[srvid]:
         try:
-            _recording = requests.get(RESTURIRECORDING % (srvid), timeout=1).json()["recording"]
+            with memberslock:
+                if srvid in members:
+                    _recording = members[srvid]["recording"]
+                else:
+                    _recording = peerclient.get(srvid, RESTURIRECORDING).json()["recording"]
             if _recording and not recording:
-                requests.put(RESTURIRECORDING % (srvid_own), json=dict(recording=True), timeout=1)
+                peerclient.put(srvid_own, RESTURIRECORDING, json=dict(recording=True))
             elif recording and not _recording:
-                requests.put(RESTURIRECORDING % (srvid), json=dict(recording=True), timeout=1)
+                peerclient.put(srvid, RESTURIRECORDING, json=dict(recording=True))
             print(f"srv.py: ADDING srv{srvid}")
 
             with lock:
                 srvs[srvid] = {}
-                loadcfg()
-                loadplayers()
-                loadmats()
-                if "retry" in srvs[srvid]:
+            sync_srv(srvid)
+            try:
+                # and the other way: writes the peer missed while out (queue pruned, never queued)
+                peerclient.post(srvid, RESTURISYNCPULL)
+            except:
+                print("srv.py: conn error", get_linenumber())
+            with lock:
+                if "retry" in srvs.get(srvid, {}):
                     print(f"srv.py: RETRY srv{srvid}")
                     del srvs[srvid]
         except:
-            pass
+            print("srv.py: conn error", get_linenumber())
+            # added again next sweep
+            with lock:
+                srvs.pop(srvid, None)
+
+
+def sync_srv(srvid):
+    # one round trip: entries changed since the watermarks of the previous sync with this peer
+    marks = syncmarks.get(srvid, dict(cams=0, players=0, mats=0))
+    start = time.perf_counter()
+    try:
+        data = peerclient.getjson(srvid, RESTURISYNC, marks["cams"], marks["players"], marks["mats"], cache=False)
+        if not (isinstance(data, dict) and isinstance(data.get("days"), list) and isinstance(data.get("watermarks"), dict) and
+                shaped(data.get("cams"), 2) and shaped(data.get("players"), 1) and shaped(data.get("mats"), 2) and
+                all("position" in cam and "mat" in cam for cfg in data["cams"].values() for cam in cfg.values())):
+            raise ValueError("bad sync reply")
+    except:
+        print("srv.py: conn error", get_linenumber())
+        metrics.inc("jcsrv_sync_total", srvid=srvid, result="error")
+        markretry(srvid)
+        return False
+    tickets = [0]
+    pastdays.announce(srvid, data["days"])
+    with cfgstore.lock:
+        cfgs = cfgstore.get()
+        _cfgs = mergecams(cfgs, data["cams"])
+        if _cfgs != cfgs:
+            cfgstore.swap(_cfgs)
+            tickets.append(commit(today, "cams", cfgs[today], _cfgs[today]))
+    with playerstore.lock:
+        players = playerstore.get()
+        _players = mergeplayers(players, data["players"])
+        if _players != players:
+            playerstore.swap(_players)
+            tickets.append(commit(today, "players", players, _players))
+    with matstore.lock:
+        mats = matstore.get()
+        _mats = mergemats(mats, data["mats"])
+        if _mats != mats:
+            matstore.swap(_mats)
+            for day in data["mats"].keys():
+                tickets.append(commit(day, "mats", mats.get(day, {}), _mats[day]))
+    try:
+        for ticket in tickets:
+            journal.wait(ticket)
+    except OSError:
+        metrics.inc("jcsrv_sync_total", srvid=srvid, result="error")
+        markretry(srvid)
+        return False
+    # margin covers entries replicated to the peer late with an older "ts"
+    syncmarks[srvid] = {domain: max(0, mark - SYNCMARGIN) for domain, mark in data["watermarks"].items()}
+    metrics.inc("jcsrv_sync_total", srvid=srvid, result="ok")
+    metrics.observe("jcsrv_sync_seconds", time.perf_counter() - start, srvid=srvid)
+    return True
+
+
+def shaped(value, depth):
+    # {id: entry} (depth 1) or {day: {id: entry}} (depth 2) with dict entries
+    if not isinstance(value, dict):
+        return False
+    return all(isinstance(entry, dict) if depth == 1 else shaped(entry, depth - 1) for entry in value.values())
+
+
+def changed(entry, mark, full=True):
+    return entry["ts"] >= mark if "ts" in entry else full
+
+
+class Sync(Resource):
+    def get(self):
+        args = parser_sync.parse_args()
+        (cfgsversion, cfgs), (playersversion, players), (matsversion, mats) = cfgstore.snapshot(), playerstore.snapshot(), matstore.snapshot()
+        localdays = pastdays.localdays()
+        tag = f"sync-{srvid_own}-{BOOTID}-{cfgsversion}-{playersversion}-{matsversion}-{len(localdays)}-{args['cams']}-{args['players']}-{args['mats']}"
+        # entries without "ts" are few and may be new, they are always sent except default mats
+        data = dict(days=sorted(set(localdays) | set(cfgs.keys())), cams={}, players={}, mats={}, watermarks=dict(cams=0, players=0, mats=0))
+        for day, cfg in cfgs.items():
+            for camid, cam in cfg.items():
+                if changed(cam, args["cams"]):
+                    data["cams"].setdefault(day, {})[camid] = cam
+                data["watermarks"]["cams"] = max(data["watermarks"]["cams"], cam.get("ts", 0))
+        for playerid, player in players.items():
+            if changed(player, args["players"]):
+                data["players"][playerid] = player
+            data["watermarks"]["players"] = max(data["watermarks"]["players"], player.get("ts", 0))
+        for day, daymats in mats.items():
+            for matid, mat in daymats.items():
+                if changed(mat, args["mats"], not args["mats"]):
+                    data["mats"].setdefault(day, {})[matid] = mat
+                data["watermarks"]["mats"] = max(data["watermarks"]["mats"], mat.get("ts", 0))
+        return conditional(data, tag)
+
+    def post(self):
+        # a peer that joined (again) asks to be pulled from, it may have writes we never got
+        if not from_srv():
+            abort(403, message="peers only")
+        try:
+            peer = int(request.headers["X-JC-Srvid"])
+        except:
+            abort(404, message="bad params")
+        if peer not in srvs:
+            abort(404, message="srv not in cluster")
+        rpcexecutor.submit(sync_srv, peer)
+        return '', 202
+
+
+def drop_srv(srvid):
+    global srvs, cams, recording
+    print(f"srv.py: DELETING srv{srvid}")
+    peerclient.close(srvid)
+    with lock:
+        for camid in [camid for camid in cams if cams[camid]["srvid"] == srvid]:
+            del cams[camid]
+        del srvs[srvid]
+    publishowners()
 
 
 class Recording(Resource):
     def get(self, camid=None):
-        global cfgs, srvs, cams, recording
+        global srvs, cams, recording
         if camid:
-            with lock:
-                if camid in cams:
-                    return dict(srvid=cams[camid]["srvid"], ts=cams[camid]["ts"])
-                else:
-                    return dict(srvid=None, ts=MAXTS)
+            cam = cams.get(camid)
+            if cam:
+                return dict(srvid=cam["srvid"], epoch=cam["epoch"], state=cam["state"])
+            else:
+                return dict(srvid=None, epoch=epochs.get(camid, 0), state=None)
         else:
             return dict(recording=recording)
 
     def put(self, camid=None):
-        global cfgs, srvs, cams, recording
+        global srvs, cams, recording
         if camid:
+            # proposal of a peer for the cam lease
             args = parser_recording_cam.parse_args()
-            add_srv(args["srvid"])
-            if args["srvid"] in srvs:
-                with lock:
-                    if camid not in cams or args["ts"] < cams[camid]["ts"]:
-                        print(f"srv.py: winner put srv{args['srvid']} cam{camid}")
-                        if camid in cams and cams[camid]["process"]:
-                            cams[camid]["process"].terminate()
-                        cams[camid] = dict(srvid=args["srvid"], ts=args["ts"], process=None, checker=0)
-            return '', 204
+            holder = leaseholder(camid, alive_srvs())
+            with lock:
+                cam = cams.get(camid)
+                known = epochs.get(camid, 0)
+                if holder and holder[1] != args["srvid"]:
+                    granted = False
+                elif args["epoch"] > known:
+                    granted = True
+                elif args["epoch"] == known and cam and cam["state"] == "tentative":
+                    # concurrent proposals of one epoch: the lower srvid wins everywhere
+                    granted = args["srvid"] <= cam["srvid"]
+                else:
+                    granted = False
+                if granted:
+                    epochs[camid] = args["epoch"]
+                    if not cam or cam["srvid"] != args["srvid"] or cam["epoch"] != args["epoch"]:
+                        cams[camid] = dict(srvid=args["srvid"], epoch=args["epoch"], state="tentative", ts=time.time())
+                        publishleases()
+                    reply = dict(granted=True, srvid=args["srvid"], epoch=args["epoch"])
+                else:
+                    reply = dict(granted=False, srvid=holder[1] if holder else cam and cam["srvid"], epoch=max(known, holder[0] if holder else 0))
+            return reply
         else:
             args = parser_recording.parse_args()
             with lock:
+                if recording != args["recording"]:
+                    events.publish("recording", dict(recording=args["recording"]))
                 recording = args["recording"]
                 if recording:
                     if not os.path.exists(recordingfile):
@@ -308,372 +1436,1458 @@ class Recording(Resource):
                 else:
                     if os.path.exists(recordingfile):
                         os.remove(recordingfile)
-            if not socket.gethostbyaddr(request.remote_addr)[0].startswith("srv"):
-                with lock:
-                    _srvs = list(srvs.keys())
-                for srvid in _srvs:
-                    try:
-                        requests.put(RESTURIRECORDING % (srvid), json=args, timeout=1)
-                    except:
-                        print("srv.py: conn error", get_linenumber())
+            if not from_srv():
+                replicator.push("PUT", RESTURIRECORDING, json=args)
             return '', 204
 
 
 def savecfg(backup=False):
-    global cfgs, srvs, cams, recording
-    if not lock.locked():
-        print("ERR not locked\n")
-    cfgfile = f"/share/{hostname}/{today}/cams.cfg"
-    if not os.path.exists(os.path.dirname(cfgfile)):
-        os.mkdir(os.path.dirname(cfgfile), mode=0o755)
-    with open(cfgfile + "_", "w") as f:
-        json.dump(cfgs[today], f, indent=4)
-    if os.path.exists(cfgfile):
-        if backup:
-            os.rename(cfgfile, cfgfile+'_' + str(int(time.time())))
-        else:
-            os.remove(cfgfile)
-    os.rename(cfgfile+'_', cfgfile)
+    cfgfile = f"{SHARE}/{hostname}/{today}/cams.cfg"
+    savejson(cfgfile, cfgstore.get()[today], backup)
 
 
 def loadcfg():
-    global cfgs, srvs, cams, recording, cfgslocal
-    if not lock.locked():
-        print("ERR not locked\n")
-    cfgs = {}
-    cfgs[today] = {}
-    cfgslocal = []
-    for day in [day for day in os.listdir(f"/share/{hostname}/") if re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', day) and os.path.exists(f"/share/{hostname}/{day}/cams.cfg")]:
-        with open(f"/share/{hostname}/{day}/cams.cfg", "r") as f:
+    # today only, past days come with pastdays.ensure()
+    with cfgstore.lock:
+        cfgs = {}
+        cfgs[today] = {}
+        if os.path.exists(f"{SHARE}/{hostname}/{today}/cams.cfg"):
+            with open(f"{SHARE}/{hostname}/{today}/cams.cfg", "r") as f:
+                try:
+                    cfgs[today] = json.load(f)
+                except:
+                    print(f"srv.py: cfg json failed {SHARE}/{hostname}/{today}/cams.cfg")
+        for camid, cam in journal.replay(today, "cams"):
+            if cam is None:
+                cfgs[today].pop(camid, None)
+            else:
+                cfgs[today][camid] = cam
+        cfgstore.swap(cfgs)
+        savecfg()
+        # savecfg() created today's directory, today's mats are journaled and saved from now on
+        cfgslocal.add(today)
+
+
+def mergecams(cfgs, remote):
+    # remote {day: {camid: cam}}, kept "ts" rule and collision resolution
+    cfgs = dict(cfgs)
+    for day, cfg in remote.items():
+        if day not in cfgs:
+            cfgs[day] = cfg
+        else:
+            daycfg = dict(cfgs[day])
+            for camid, cam in cfg.items():
+                if camid not in daycfg:
+                    daycfg[camid] = cam
+                else:
+                    if daycfg[camid]["position"] != cam["position"] or daycfg[camid]["mat"] != cam["mat"]:
+                        print(f"srv.py: cfg differs {daycfg[camid]} {cam}")
+                        if "ts" in cam and ("ts" not in daycfg[camid] or daycfg[camid]["ts"] > cam["ts"]):
+                            # replace with newer "ts"
+                            daycfg[camid] = cam
+            # resolve colisions
+            movecams = []
+            for camid, cam in daycfg.items():
+                for _camid, _cam in daycfg.items():
+                    if camid != _camid:
+                        if cam["position"] == _cam["position"] and cam["mat"] == _cam["mat"]:
+                            print(f"srv.py: cfg collision {camid} {_camid}")
+                            if "ts" in cam and ("ts" not in _cam or _cam["ts"] > cam["ts"]):
+                                movecams.append(camid)
+                                daycfg[camid] = dict(mat=0, position=0)
+
+            for camid in movecams:
+                daycfg[camid] = freeposition(daycfg)
+            cfgs[day] = daycfg
+    return cfgs
+
+
+def freeposition(daycfg):
+    for (m, p) in [(m, p) for m in range(1, MAXMAT+1) for p in range(1, MAXPOS+1)]:
+        for cam in daycfg.values():
+            if cam["mat"] == m and cam["position"] == p:
+                break
+        else:
+            break
+    return dict(mat=m, position=p)
+
+
+class PastDays:
+    # past days are immutable: cams/mats are loaded on first access (local files revalidated by
+    # mtime, days only on peers fetched from them), startup and resync touch today only
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mtimes = {}
+        self.remote = {}
+        self.listing = (None, [])
+
+    def localdays(self):
+        # directory listing cached by mtime of the share
+        mtime = os.path.getmtime(f"{SHARE}/{hostname}/")
+        if self.listing[0] != mtime:
+            self.listing = (mtime, [day for day in os.listdir(f"{SHARE}/{hostname}/") if re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', day)])
+        return self.listing[1]
+
+    def days(self):
+        alive = alive_srvs()
+        remote = [day for day, srvids in self.remote.items() if srvids & set(alive)]
+        return sorted(set(self.localdays()) | set(cfgstore.get().keys()) | set(remote))
+
+    def announce(self, srvid, days):
+        with self.lock:
+            for day in days:
+                self.remote.setdefault(day, set()).add(srvid)
+
+    def forget(self, day):
+        with self.lock:
+            self.mtimes.pop(day, None)
+            self.remote.pop(day, None)
+
+    def ensure(self, day):
+        # True when the day exists here or on an alive peer, loaded into cfgstore/matstore
+        if day == today:
+            return True
+        if not day or not re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', day):
+            return False
+        cfgfile = f"{SHARE}/{hostname}/{day}/cams.cfg"
+        try:
+            mtime = os.path.getmtime(cfgfile)
+        except OSError:
+            mtime = None
+        if mtime is not None:
+            if self.mtimes.get(day) != mtime:
+                with self.lock:
+                    if self.mtimes.get(day) != mtime:
+                        self.loadlocal(day, cfgfile, mtime)
+            return True
+        if day in cfgstore.get():
+            return True
+        with self.lock:
+            if day not in cfgstore.get():
+                self.fetch(day)
+        return day in cfgstore.get()
+
+    def loadlocal(self, day, cfgfile, mtime):
+        with open(cfgfile, "r") as f:
             try:
-                cfgs[day] = json.load(f)
-                cfgslocal.append(day)
+                cfg = json.load(f)
             except:
-                print(f"srv.py: cfg json failed /share/{hostname}/{day}/cams.cfg")
-    for srvid in srvs.keys():
-        try:
-            for day in requests.get(RESTURICAMS % (srvid), timeout=1).json():
-                cfg = requests.get(RESTURICAMSDATE % (srvid, day), timeout=1).json()
-                if day not in cfgs:
-                    cfgs[day] = cfg
-                else:
-                    for camid, cam in cfg.items():
-                        if camid not in cfgs[day]:
-                            cfgs[day][camid] = cam
-                        else:
-                            if cfgs[day][camid]["position"] != cam["position"] or cfgs[day][camid]["mat"] != cam["mat"]:
-                                print(f"srv.py: cfg differs {cfgs[day][camid]} {cam}")
-                                if "ts" in cam and ("ts" not in cfgs[day][camid] or cfgs[day][camid]["ts"] > cam["ts"]):
-                                    # replace with newer "ts"
-                                    cfgs[day][camid] = cam
-                    # resolve colisions
-                    movecams = []
-                    for camid, cam in cfgs[day].items():
-                        for _camid, _cam in cfgs[day].items():
-                            if camid != _camid:
-                                if cam["position"] == _cam["position"] and cam["mat"] == _cam["mat"]:
-                                    print(f"srv.py: cfg collision {camid} {_camid}")
-                                    if "ts" in cam and ("ts" not in _cam or _cam["ts"] > cam["ts"]):
-                                        movecams.append(camid)
-                                        cfgs[day][camid] = dict(mat=0, position=0)
-
-                    for camid in movecams:
-                        for (m, p) in [(m, p) for m in range(1, MAXMAT+1) for p in range(1, MAXPOS+1)]:
-                            for cam in cfgs[day].values():
-                                if cam["mat"] == m and cam["position"] == p:
-                                    break
-                            else:
-                                break
-                        cfgs[day][camid] = dict(mat=m, position=p)
-        except:
-            print("srv.py: conn error", get_linenumber())
-            srvs[srvid]["retry"] = True
-    savecfg()
+                print(f"srv.py: cfg json failed {cfgfile}")
+                return
+        daymats = readmats(day)
+        cfgslocal.add(day)
+        with cfgstore.lock:
+            cfgstore.swap(replaced(cfgstore.get(), day, cfg))
+        with matstore.lock:
+            matstore.swap(replaced(matstore.get(), day, daymats))
+        self.mtimes[day] = mtime
+
+    def fetch(self, day):
+        alive = alive_srvs()
+        for srvid in [srvid for srvid in self.remote.get(day, ()) if srvid in alive]:
+            try:
+                cfg = peerclient.getjson(srvid, RESTURICAMSDATE, day)
+                if not shaped(cfg, 1) or not all("position" in cam and "mat" in cam for cam in cfg.values()):
+                    raise ValueError("bad cams reply")
+            except:
+                print("srv.py: conn error", get_linenumber())
+                continue
+            try:
+                # a peer announces a day for its cams, it may have no mats for it (404): default mats
+                daymats = peerclient.getjson(srvid, RESTURIMATSDATE, day)
+                daymats = {matid: mat for matid, mat in daymats.items() if isinstance(mat, dict)} if isinstance(daymats, dict) else {}
+            except:
+                print("srv.py: conn error", get_linenumber())
+                daymats = {}
+            with cfgstore.lock:
+                cfgstore.swap(mergecams(cfgstore.get(), {day: cfg}))
+            with matstore.lock:
+                matstore.swap(mergemats(matstore.get(), {day: daymats}))
+            return
+
+
+pastdays = PastDays()
 
 
 class Cam(Resource):
     def get(self, day=None, camid=None):
-        global cfgs, srvs, cams, recording
-        with lock:
-            if day:
-                if day in cfgs:
-                    return cfgs[day] if not camid else cfgs[day][str(camid)]
-                return {}
-            else:
-                return list(cfgs.keys())
+        if day:
+            pastdays.ensure(day)
+            version, cfgs = cfgstore.snapshot()
+            if day in cfgs:
+                return conditional(cfgs[day] if not camid else cfgs[day][str(camid)], versiontag("cams", version))
+            return {}
+        else:
+            days = pastdays.days()
+            return conditional(days, contenttag(days))
         abort(404, message="bad params")
 
     def post(self, day=None, camid=None):
-        global cfgs, srvs, cams, recording
         if day == today and camid:
             args = parser_cam.parse_args()
-            with lock:
+            with cfgstore.lock:
+                cfgs = cfgstore.get()
+                daycfg = dict(cfgs[day])
                 ts = int(time.time())
-                for camidswap, cam in cfgs[day].items():
+                for camidswap, cam in daycfg.items():
                     if cam["position"] == args["position"] and cam["mat"] == args["mat"]:
-                        if str(camid) in cfgs[day]:
-                            cfgs[day][camidswap] = cfgs[day][str(camid)]
-                            cfgs[day][camidswap]["ts"] = ts
+                        if str(camid) in daycfg:
+                            daycfg[camidswap] = dict(daycfg[str(camid)], ts=ts)
                         else:
                             # fail to swap
-                            del cfgs[day][camidswap]
+                            del daycfg[camidswap]
                         break
-                cfgs[day][str(camid)] = args
-                cfgs[day][str(camid)]["ts"] = ts
-                savecfg(backup=True)
-            if not socket.gethostbyaddr(request.remote_addr)[0].startswith("srv"):
-                with lock:
-                    _srvs = list(srvs.keys())
-                for srvid in _srvs:
-                    try:
-                        requests.post(RESTURICAMSDATECAM % (srvid, day, camid), json=args, timeout=1)
-                    except:
-                        print("srv.py: conn error", get_linenumber())
+                args["ts"] = ts
+                daycfg[str(camid)] = args
+                cfgstore.swap(replaced(cfgs, day, daycfg))
+                ticket = commit(today, "cams", cfgs[today], daycfg, edit=True)
+            journal.wait(ticket)
+            if not from_srv():
+                replicator.push("POST", RESTURICAMSDATECAM, day, camid, json=args)
             return '', 204
         abort(404, message="bad params")
 
 
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+
+class ChunkIndex:
+    # sorted integer array of chunk timestamps per (day, camid), kept current by inotify
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chunks = {}
+        self.upper = {}
+        self.names = {}
+        self.watches = {}
+        self.libc = None
+        self.fd = -1
+
+    def start(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError):
+            self.fd = -1
+        if self.fd < 0:
+            print("srv.py: inotify not available, chunk listing falls back to directory rescans")
+            return False
+        with self.lock:
+            self.watch(f"{SHARE}/{hostname}/", (None, None))
+            for entry in os.scandir(f"{SHARE}/{hostname}/"):
+                if entry.is_dir() and re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', entry.name):
+                    self.watchday(entry.name)
+        threading.Thread(target=self.run, daemon=True).start()
+        return True
+
+    def active(self):
+        return self.fd >= 0
+
+    def watch(self, path, key):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(), IN_MASK)
+        if wd < 0:
+            print(f"srv.py: inotify watch failed {path} errno {ctypes.get_errno()}")
+        else:
+            self.watches[wd] = key
+
+    def watchday(self, day):
+        self.watch(f"{SHARE}/{hostname}/{day}/", (day, None))
+        for entry in os.scandir(f"{SHARE}/{hostname}/{day}/"):
+            if entry.is_dir() and re.fullmatch(r'^cam\d{2}$', entry.name):
+                self.watchcam(day, int(entry.name[-2:]))
+
+    def watchcam(self, day, camid):
+        # watch before scan, chunks created in between are merged by add()
+        path = f"{SHARE}/{hostname}/{day}/cam{camid:02d}/"
+        self.watch(path, (day, camid))
+        names = [entry.name[:-3] for entry in os.scandir(path) if re.fullmatch(r'^[0-9a-fA-F]{11}.ts$', entry.name)]
+        values = array.array('Q', sorted(set(int(name, 16) for name in names)))
+        if (day, camid) in self.chunks:
+            values = array.array('Q', sorted(set(values) | set(self.chunks[(day, camid)])))
+        self.chunks[(day, camid)] = values
+        self.upper[(day, camid)] = any(name != name.lower() for name in names)
+        self.names.pop((day, camid), None)
+
+    def unwatchday(self, day):
+        for wd in [wd for wd, key in self.watches.items() if key[0] == day]:
+            self.libc.inotify_rm_watch(self.fd, wd)
+            del self.watches[wd]
+        for key in [key for key in self.chunks.keys() if key[0] == day]:
+            del self.chunks[key]
+            self.names.pop(key, None)
+
+    def add(self, key, name):
+        value = int(name, 16)
+        values = self.chunks.setdefault(key, array.array('Q'))
+        i = bisect.bisect_left(values, value)
+        if i == len(values) or values[i] != value:
+            values.insert(i, value)
+            self.upper[key] = self.upper.get(key, False) or name != name.lower()
+            self.names.pop(key, None)
+            events.publish("chunk", dict(day=key[0], camid=key[1], chunk=name, srvid=srvid_own))
+            metrics.inc("jcsrv_chunks_created_total", camid=key[1])
+            handover = handovers.get(key[1]) if key[0] == today else None
+            if handover:
+                handover["boundary"] = True
+                liveevents.put(("chunk", key[1], True))
+
+    def remove(self, key, name):
+        value = int(name, 16)
+        values = self.chunks.get(key)
+        if values:
+            i = bisect.bisect_left(values, value)
+            if i < len(values) and values[i] == value:
+                del values[i]
+                self.names.pop(key, None)
+
+    def rescan(self):
+        print("srv.py: inotify queue overflow, rescanning")
+        metrics.inc("jcsrv_chunk_rescans_total", source="inotify")
+        for wd in list(self.watches.keys()):
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches = {}
+        self.chunks = {}
+        self.names = {}
+        self.watch(f"{SHARE}/{hostname}/", (None, None))
+        for entry in os.scandir(f"{SHARE}/{hostname}/"):
+            if entry.is_dir() and re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', entry.name):
+                self.watchday(entry.name)
+
+    def event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.rescan()
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        if wd not in self.watches:
+            return
+        day, camid = self.watches[wd]
+        created = mask & (IN_CREATE | IN_MOVED_TO)
+        try:
+            if day is None:
+                if mask & IN_ISDIR and re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', name):
+                    if created:
+                        self.watchday(name)
+                    else:
+                        self.unwatchday(name)
+            elif camid is None:
+                if mask & IN_ISDIR and re.fullmatch(r'^cam\d{2}$', name):
+                    if created:
+                        self.watchcam(day, int(name[-2:]))
+                    else:
+                        self.chunks.pop((day, int(name[-2:])), None)
+                        self.names.pop((day, int(name[-2:])), None)
+            elif re.fullmatch(r'^[0-9a-fA-F]{11}.ts$', name):
+                if created:
+                    self.add((day, camid), name[:-3])
+                else:
+                    self.remove((day, camid), name[:-3])
+        except OSError as e:
+            # directory vanished before it was scanned
+            print(f"srv.py: inotify {day} {camid} {name} {e}")
+
+    def run(self):
+        print("CHUNKINDEX thread start")
+        while True:
+            buf = os.read(self.fd, 65536)
+            offset = 0
+            with self.lock:
+                while offset < len(buf):
+                    wd, mask, cookie, length = struct.unpack_from('iIII', buf, offset)
+                    name = buf[offset+16:offset+16+length].rstrip(b'\0').decode(errors='replace')
+                    offset += 16 + length
+                    self.event(wd, mask, name)
+
+    def cams(self, day):
+        with self.lock:
+            return sorted(camid for (_day, camid) in self.chunks.keys() if _day == day)
+
+    def get(self, day, camid):
+        # cached name list, rebuilt only after the chunk set changed
+        key = (day, camid)
+        with self.lock:
+            if key not in self.names:
+                fmt = '011X' if self.upper.get(key) else '011x'
+                self.names[key] = [format(value, fmt) for value in self.chunks.get(key, ())]
+            return self.names[key]
+
+    def slice(self, day, camid, lo=None, hi=None):
+        # chunk names with lo <= ts <= hi, O(log n) search
+        key = (day, camid)
+        with self.lock:
+            values = self.chunks.get(key, array.array('Q'))
+            i = bisect.bisect_left(values, lo) if lo is not None else 0
+            j = bisect.bisect_right(values, hi) if hi is not None else len(values)
+            fmt = '011X' if self.upper.get(key) else '011x'
+            return [format(value, fmt) for value in values[i:j]]
+
+
+chunkindex = ChunkIndex()
+
+
 def getpaths(day, camid):
-    path = f"/share/{hostname}/{day}/cam{camid:02d}/"
+    if chunkindex.active():
+        return chunkindex.get(day, camid)
+    path = f"{SHARE}/{hostname}/{day}/cam{camid:02d}/"
     if os.path.exists(path):
         if path not in pathts or pathts[path] != os.path.getmtime(path):
+            metrics.inc("jcsrv_chunk_rescans_total", source="mtime")
             pathts[path] = os.path.getmtime(path)
             pathcache[path] = []
-            for tsname in [tsname for tsname in os.listdir(f"/share/{hostname}/{day}/cam{camid:02d}/") if re.fullmatch(r'^[0-9a-fA-F]{11}.ts$', tsname)]:
+            for tsname in sorted([tsname for tsname in os.listdir(f"{SHARE}/{hostname}/{day}/cam{camid:02d}/") if re.fullmatch(r'^[0-9a-fA-F]{11}.ts$', tsname)]):
                 pathcache[path].append(tsname[:-3])
         return pathcache[path]
     return []
 
 
+def slicechunks(names, lo=None, hi=None):
+    # names are sorted fixed width hex timestamps
+    i = bisect.bisect_left(names, lo, key=lambda name: int(name, 16)) if lo is not None else 0
+    j = bisect.bisect_right(names, hi, key=lambda name: int(name, 16)) if hi is not None else len(names)
+    return names[i:j]
+
+
+def getrange(day, camid, lo=None, hi=None):
+    if lo is None and hi is None:
+        return getpaths(day, camid)
+    if chunkindex.active():
+        return chunkindex.slice(day, camid, lo, hi)
+    return slicechunks(getpaths(day, camid), lo, hi)
+
+
+class ChunkCache:
+    # LRU of immutable past-day remote chunk lists per (srvid, day), bounded by total chunk names
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.dirty = False
+
+    def get(self, srvid, day, camid=None):
+        with self.lock:
+            entry = self.entries.get((srvid, day))
+            if not entry or (camid and camid not in entry["cams"]) or (not camid and not entry["complete"]):
+                return None
+            self.entries.move_to_end((srvid, day))
+            return {camid: entry["cams"][camid]} if camid else dict(entry["cams"])
+
+    def put(self, srvid, day, lines, complete=False):
+        with self.lock:
+            entry = self.entries.setdefault((srvid, day), dict(complete=False, cams={}))
+            for line in lines:
+                self.size += len(line["ts"]) - len(entry["cams"].get(line["camid"], []))
+                entry["cams"][line["camid"]] = line["ts"]
+            entry["complete"] = entry["complete"] or complete
+            self.entries.move_to_end((srvid, day))
+            while self.size > CHUNKCACHEMAX and len(self.entries) > 1:
+                _, entry = self.entries.popitem(last=False)
+                self.size -= sum(len(names) for names in entry["cams"].values())
+            self.dirty = True
+
+    def invalidate(self, day):
+        with self.lock:
+            for key in [key for key in self.entries.keys() if key[1] == day]:
+                self.size -= sum(len(names) for names in self.entries.pop(key)["cams"].values())
+                self.dirty = True
+
+    def load(self):
+        if os.path.exists(CHUNKCACHEFILE):
+            with open(CHUNKCACHEFILE, "r") as f:
+                try:
+                    for srvid, day, complete, _cams in json.load(f):
+                        self.put(srvid, day, [dict(camid=int(camid), ts=names) for camid, names in _cams.items()], complete)
+                except:
+                    print(f"srv.py: chunk cache json failed {CHUNKCACHEFILE}")
+        self.dirty = False
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = [(srvid, day, entry["complete"], entry["cams"]) for (srvid, day), entry in self.entries.items()]
+            self.dirty = False
+        with open(CHUNKCACHEFILE + "_", "w") as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(CHUNKCACHEFILE + "_", CHUNKCACHEFILE)
+
+    def save_thread(self):
+        # serializing up to CHUNKCACHEMAX names takes a while, never in live_thread
+        print("CHUNKCACHE thread start")
+        while not stopping.wait(CHUNKCACHESAVE):
+            self.save()
+
+    def start(self):
+        threading.Thread(target=self.save_thread, daemon=True).start()
+
+
+chunkcache = ChunkCache()
+
+
+def cachedchunks(srvid, cache, camid=None, lo=None, hi=None):
+    return [dict(srvid=srvid, camid=_camid, ts=slicechunks(cache[_camid], lo, hi)) for _camid in ([camid] if camid else list(cache.keys()))]
+
+
+def fetchchunks(srvid, cache, day, camid=None, lo=None, hi=None):
+    # past days are fetched whole into the chunk cache and sliced here, today is filtered by the peer
+    params = {}
+    if day == today:
+        if lo is not None:
+            params["from"] = f"{lo:x}"
+        if hi is not None:
+            params["to"] = f"{hi:x}"
+    try:
+        if params:
+            uri, args = (RESTURICHUNKSDATECAM, (day, camid)) if camid else (RESTURICHUNKSDATE, (day,))
+            response = peerclient.get(srvid, uri, *args, params=params, timeout=CHUNKSDEADLINE)
+            response.raise_for_status()
+            lines = response.json()
+        elif camid:
+            lines = peerclient.getjson(srvid, RESTURICHUNKSDATECAM, day, camid, timeout=CHUNKSDEADLINE, cache=day == today)
+        else:
+            lines = peerclient.getjson(srvid, RESTURICHUNKSDATE, day, timeout=CHUNKSDEADLINE, cache=day == today)
+    except:
+        print("srv.py: conn error", get_linenumber())
+        raise
+    # late replies still refresh the cache for the next request
+    if day != today:
+        chunkcache.put(srvid, day, lines, complete=not camid)
+    for line in lines:
+        if day == today and not params:
+            cache[line["camid"]] = line["ts"]
+        if line["srvid"] != srvid or (camid and line["camid"] != camid):
+            print(f"srv.py: ERR srv/camid not match {line['srvid']} {srvid} {line['camid']} {camid}")
+    if not params and (lo is not None or hi is not None):
+        lines = [dict(line, ts=slicechunks(line["ts"], lo, hi)) for line in lines]
+    return lines
+
+
+def listchunks(day, camid, lo, hi, fanout):
+    chlist = []
+    if camid:
+        chlist.append(dict(srvid=srvid_own, camid=camid, ts=getrange(day, camid, lo, hi)))
+    else:
+        if chunkindex.active():
+            _camids = chunkindex.cams(day)
+        else:
+            _camids = [int(camname[-2:]) for camname in os.listdir(f"{SHARE}/{hostname}/{day}/") if re.fullmatch(r'^cam\d{2}$', camname)]
+        for _camid in _camids:
+            chlist.append(dict(srvid=srvid_own, camid=_camid, ts=getrange(day, _camid, lo, hi)))
+
+    missing = []
+    stale = []
+    if fanout:
+        with lock:
+            _srvs = {srvid: srvs[srvid].setdefault(today, {}) for srvid in srvs.keys()}
+        futures = {}
+        for srvid, cache in _srvs.items():
+            cached = chunkcache.get(srvid, day, camid) if day != today else None
+            if cached is not None:
+                # use cache
+                chlist.extend(cachedchunks(srvid, cached, camid, lo, hi))
+            else:
+                futures[rpcexecutor.submit(rpcflight.do, ("chunks", srvid, day, camid, lo, hi), fetchchunks, srvid, cache, day, camid, lo, hi)] = srvid
+        # scatter to all peers at once, gather what arrives before the deadline
+        done, _ = concurrent.futures.wait(futures, timeout=CHUNKSDEADLINE)
+        for future, srvid in futures.items():
+            if future in done and not future.exception():
+                chlist.extend(future.result())
+            elif day == today and _srvs[srvid] and (not camid or camid in _srvs[srvid]):
+                stale.append(srvid)
+                chlist.extend([dict(line, stale=True) for line in cachedchunks(srvid, _srvs[srvid], camid, lo, hi)])
+            else:
+                missing.append(srvid)
+    return chlist, missing, stale, contenttag(chlist)
+
+
+class Deleter:
+    # day deletion in the background: the day directory is renamed away at once, cameras are
+    # removed in parallel at idle I/O priority, peers are asked all at the same time
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=DELWORKERS, initializer=self.idle)
+
+    def idle(self):
+        # per thread I/O class idle, recording keeps the disk
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            if libc.syscall(IOPRIO_SET[os.uname().machine], IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << 13) < 0:
+                print(f"srv.py: ioprio_set failed errno {ctypes.get_errno()}")
+        except (OSError, KeyError, AttributeError):
+            print("srv.py: ioprio_set not available")
+
+    def trash(self, day, jobid):
+        return f"{SHARE}/{hostname}/.trash-{day}-{jobid}"
+
+    def submit(self, day, peers):
+        jobid = int(time.time()*1000)
+        path = f"{SHARE}/{hostname}/{day}/"
+        job = dict(id=jobid, day=day, state="running", started=time.time(), finished=None, entries=0, done=0,
+                   peers={str(srvid): "pending" for srvid in peers})
+        with self.lock:
+            self.jobs[jobid] = job
+            while len(self.jobs) > DELJOBSMAX:
+                self.jobs.popitem(last=False)
+        if os.path.exists(path):
+            try:
+                os.rename(path, self.trash(day, jobid))
+            except OSError as e:
+                print(f"srv.py: delete {day} rename failed {e}")
+                with self.lock:
+                    job.update(state="error", finished=time.time(), peers={}, error=str(e))
+                return dict(job)
+        threading.Thread(target=self.run, args=(job, self.trash(day, jobid)), daemon=True).start()
+        for srvid in peers:
+            rpcexecutor.submit(self.peer, job, srvid)
+        return dict(job)
+
+    def peer(self, job, srvid):
+        try:
+            # a peer deleting today first waits up to SRVSTOPTIMEOUT for its recorders
+            response = peerclient.delete(srvid, RESTURICHUNKSDATE, job["day"], timeout=SRVSTOPTIMEOUT + RPCTIMEOUT, retries=0)
+            state = "done" if response.status_code < 300 else f"error {response.status_code}"
+        except:
+            print("srv.py: conn error", get_linenumber())
+            state = "error"
+        with self.lock:
+            job["peers"][str(srvid)] = state
+            self.finish(job)
+
+    def run(self, job, trash):
+        if os.path.exists(trash):
+            entries = [entry.path for entry in os.scandir(trash)]
+            with self.lock:
+                job["entries"] = len(entries)
+            for future in concurrent.futures.as_completed([self.executor.submit(self.remove, entry) for entry in entries]):
+                with self.lock:
+                    job["done"] += 1
+            self.executor.submit(shutil.rmtree, trash, ignore_errors=True).result()
+        with self.lock:
+            job["removed"] = True
+            self.finish(job)
+
+    def remove(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+    def finish(self, job):
+        if job.get("removed") and "pending" not in job["peers"].values():
+            job["state"] = "done" if all(state == "done" for state in job["peers"].values()) else "error"
+            job["finished"] = time.time()
+            print(f"srv.py: deleted {job['day']} {job['state']} in {job['finished'] - job['started']:.1f}s")
+
+    def status(self, jobid=None):
+        with self.lock:
+            if jobid:
+                job = self.jobs.get(jobid)
+                return {key: value for key, value in job.items() if key != "removed"} if job else None
+            return [{key: value for key, value in job.items() if key != "removed"} for job in self.jobs.values()]
+
+    def start(self):
+        # trash left by a restart in the middle of a deletion
+        for entry in os.scandir(f"{SHARE}/{hostname}/"):
+            match = re.fullmatch(r'^\.trash-(\d{4}-\d{2}-\d{2})-(\d+)$', entry.name)
+            if match and entry.is_dir():
+                job = dict(id=int(match.group(2)), day=match.group(1), state="running", started=time.time(), finished=None, entries=0, done=0, peers={})
+                with self.lock:
+                    self.jobs[job["id"]] = job
+                threading.Thread(target=self.run, args=(job, entry.path), daemon=True).start()
+
+
+deleter = Deleter()
+
+
 class Chunks(Resource):
     def delete(self, day=None, camid=None):
-        global cfgs, srvs, cams, recording, deleting
+        global srvs, cams, recording, deleting
         if day and not camid:
+            pastdays.ensure(day)
+            peer = from_srv()
             with lock:
-                if not re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', day) or day not in cfgs:
+                if not re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', day) or day not in cfgstore.get():
                     abort(404, message="bad params")
 
                 deleting = day
+                chunkcache.invalidate(day)
+                for srvid in srvs.keys():
+                    srvs[srvid].pop(day, None)
 
                 if day == today:
                     for camid in cams.keys():
                         if cams[camid]["srvid"] == srvid_own:
-                            if cams[camid]["process"]:
-                                cams[camid]["process"].terminate()
-                        # block restart until rmtree
-                        cams[camid] = dict(srvid=None, ts=MAXTS, process=None, checker=0)
+                            supervisor.stop(camid)
+                        # block restart until the day is renamed away
+                        cams[camid] = dict(srvid=None, epoch=epochs.get(camid, 0), state="blocked", ts=time.time())
+                    publishleases()
                 else:
-                    del (cfgs[day])
-            shutil.rmtree(f"/share/{hostname}/{day}/", ignore_errors=True)
+                    with cfgstore.lock:
+                        cfgstore.swap(replaced(cfgstore.get(), day, None))
+                    with matstore.lock:
+                        matstore.swap(replaced(matstore.get(), day, None))
+                    cfgslocal.discard(day)
+                    journal.forget(day)
+                    pastdays.forget(day)
+                _srvs = list(srvs.keys()) if not peer else []
+            if day == today:
+                # recorders must be gone before the rename, new chunks would land in the trash
+                supervisor.wait(list(cams.keys()))
+            job = deleter.submit(day, _srvs)
+            if job["state"] == "error":
+                # nothing was deleted: unblock the cams, a past day reloads from its files
+                with lock:
+                    if day == today:
+                        cams = {}
+                        publishleases()
+                    deleting = None
+                return job, 500
             with lock:
                 if day == today:
                     cams = {}
-                    savecfg()
-                    saveplayers()
+                    publishleases()
+                    with cfgstore.lock:
+                        savecfg()
+                    with playerstore.lock:
+                        saveplayers()
                     if recording:
                         open(recordingfile, "x").close()
-
-            if not socket.gethostbyaddr(request.remote_addr)[0].startswith("srv"):
-                with lock:
-                    _srvs = list(srvs.keys())
-                for srvid in _srvs:
-                    try:
-                        requests.delete(RESTURICHUNKSDATE % (srvid, day), timeout=90)
-                    except:
-                        print("srv.py: conn error", get_linenumber())
-            with lock:
                 deleting = None
-            return '', 204
+            return job, 202, {"Location": f"/api/v1/deletions/{job['id']}"}
         abort(404, message="bad params")
 
     def get(self, day=None, camid=None):
-        global cfgs, srvs, cams, recording
         if day:
-            with lock:
-                if deleting == day:
-                    return []
-                if not re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', day) or day not in cfgs:
-                    abort(404, message="bad params")
-            chlist = []
-            if camid:
-                chlist.append(dict(srvid=srvid_own, camid=camid, ts=getpaths(day, camid)))
-            else:
-                for camid in [int(camname[-2:]) for camname in os.chlistdir(f"/share/{hostname}/{day}/") if re.fullmatch(r'^cam\d{2}$', camname)]:
-                    chlist.append(dict(srvid=srvid_own, camid=camid, ts=getpaths(day, camid)))
-
-            if not socket.gethostbyaddr(request.remote_addr)[0].startswith("srv"):
-                with lock:
-                    _srvs = list(srvs.keys())
-                for srvid in _srvs:
-                    if day not in srvs[srvid]:
-                        srvs[srvid][day] = {}
-                    if day != today and srvs[srvid][day] and (not camid or camid in srvs[srvid][day]):
-                        # use cache
-                        if camid:
-                            chlist.append(dict(srvid=srvid, camid=camid, ts=srvs[srvid][day][camid]))
-                        else:
-                            for camid in srvs[srvid][day].keys():
-                                chlist.append(dict(srvid=srvid, camid=camid, ts=srvs[srvid][day][camid]))
-                    else:
-                        try:
-                            if camid:
-                                response = requests.get(RESTURICHUNKSDATECAM % (srvid, day, camid), timeout=1)
-                                line = response.json()[0]
-                                srvs[srvid][day][camid] = line["ts"]
-                                if line["srvid"] != srvid or line["camid"] != camid:
-                                    print(f"srv.py: ERR srv/camid not match {line['srvid']} {srvid} {line['camid']} {camid}")
-                                chlist.extend(response.json())
-                            else:
-                                response = requests.get(RESTURICHUNKSDATE % (srvid, day), timeout=1)
-                                for line in response.json():
-                                    srvs[srvid][day][line["camid"]] = line["ts"]
-                                    if line["srvid"] != srvid:
-                                        print(f"srv.py: ERR srv not match {line['srvid']} {srvid}")
-                                chlist.extend(response.json())
-                        except:
-                            print("srv.py: conn error", get_linenumber())
-            return chlist
+            if deleting == day:
+                return []
+            pastdays.ensure(day)
+            if not re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', day) or day not in cfgstore.get():
+                abort(404, message="bad params")
+            args = parser_chunks.parse_args()
+            lo = args["from"]
+            if args["since"] is not None:
+                lo = max(lo or 0, args["since"] + 1)
+            hi = args["to"]
+            fanout = not from_srv()
+            chlist, missing, stale, tag = chunksflight.do((day, camid, lo, hi, fanout), listchunks, day, camid, lo, hi, fanout)
+            headers = {}
+            if missing:
+                headers["X-Missing-Srvs"] = ",".join(str(srvid) for srvid in missing)
+            if stale:
+                headers["X-Stale-Srvs"] = ",".join(str(srvid) for srvid in stale)
+            return conditional(chlist, tag, headers)
         abort(404, message="bad params")
 
 
+class Chunk(Resource):
+    def get(self, day=None, camid=None, chunk=None):
+        # one .ts chunk, conditional and Range requests by send_file, other servers' chunks are redirected
+        name = chunk[:-3] if chunk.endswith(".ts") else chunk
+        if not re.fullmatch(r'^\d{4}-\d{2}-\d{2}$', day) or not re.fullmatch(r'^[0-9a-fA-F]{11}$', name) or deleting == day:
+            abort(404, message="bad params")
+        path = f"{SHARE}/{hostname}/{day}/cam{camid:02d}/{name}.ts"
+        if os.path.exists(path):
+            metrics.inc("jcsrv_chunk_downloads_total", result="local")
+            # the newest chunk of today may still grow
+            growing = day == today and not getrange(day, camid, int(name, 16) + 1, None)
+            response = send_file(path, mimetype="video/mp2t", conditional=True, etag=True, max_age=0 if growing else CHUNKMAXAGE)
+            response.headers["Cache-Control"] = "no-cache" if growing else f"public, max-age={CHUNKMAXAGE}, immutable"
+            return response
+        if not from_srv():
+            value = int(name, 16)
+            chlist = chunksflight.do((day, camid, value, value, True), listchunks, day, camid, value, value, True)[0]
+            for line in chlist:
+                if line["srvid"] != srvid_own and line["ts"]:
+                    metrics.inc("jcsrv_chunk_downloads_total", result="redirect")
+                    return redirect(RESTURICHUNKSDATECAMCHUNK % (line["srvid"], day, camid, line["ts"][0]), code=307)
+        metrics.inc("jcsrv_chunk_downloads_total", result="missing")
+        abort(404, message="no chunk")
+
+
+class Events(Resource):
+    def get(self):
+        # server-sent events, resume with Last-Event-ID header or ?since=<id>
+        resume = request.headers.get("Last-Event-ID") or request.args.get("since")
+        with events.cond:
+            if events.clients >= EVENTSCLIENTS:
+                abort(503, message="too many event clients")
+            seq = events.seq
+        if resume:
+            try:
+                boot, _seq = [int(value) for value in resume.split("-")]
+                # another boot: force reset
+                seq = _seq if boot == BOOTID else -1
+            except ValueError:
+                seq = -1
+        return Response(stream_with_context(events.stream(seq)), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+class Deletions(Resource):
+    def get(self, jobid=None):
+        if jobid:
+            job = deleter.status(jobid)
+            if job:
+                return job
+            abort(404, message="bad params")
+        return deleter.status()
+
+
+class Placement(Resource):
+    def get(self):
+        alive = alive_srvs()
+        _loads = loads(alive)
+        with lock:
+            assignment = {str(camid): dict(srvid=cam["srvid"], epoch=cam["epoch"], state=cam["state"]) for camid, cam in cams.items()}
+            _handovers = {str(camid): dict(handover) for camid, handover in handovers.items()}
+        return dict(servers={str(srvid): dict(load, score=score(load)) for srvid, load in _loads.items()}, cams=assignment, handovers=_handovers)
+
+
+class Recorders(Resource):
+    def get(self):
+        return supervisor.stats()
+
+
+class Metrics(Resource):
+    def get(self):
+        camids = chunkindex.cams(today) if chunkindex.active() else range(1, MAXCAM+1)
+        gauges = [("jcsrv_chunks", dict(camid=camid), len(getpaths(today, camid))) for camid in camids]
+        gauges.append(("jcsrv_recorders_running", {}, sum(stat["running"] for stat in supervisor.stats().values())))
+        gauges.append(("jcsrv_members_alive", {}, len(alive_srvs())))
+        gauges.append(("jcsrv_event_clients", {}, events.clients))
+        return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+@app.before_request
+def before_request():
+    request.environ["jcsrv.start"] = time.perf_counter()
+
+
+@app.after_request
+def after_request(response):
+    if "jcsrv.start" in request.environ:
+        metrics.observe("jcsrv_http_request_seconds", time.perf_counter() - request.environ["jcsrv.start"],
+                        endpoint=request.endpoint, method=request.method, code=response.status_code)
+    return response
+
+
+class Replication(Resource):
+    def get(self):
+        return {str(srvid): status for srvid, status in replicator.status().items()}
+
+
 api.add_resource(Recording, '/api/v1/recording', '/api/v1/recording/<int:camid>')
 api.add_resource(Cam, '/api/v1/cams', '/api/v1/cams/<string:day>', '/api/v1/cams/<string:day>/<int:camid>')
 api.add_resource(Chunks, '/api/v1/chunks/<string:day>', '/api/v1/chunks/<string:day>/<int:camid>')
+api.add_resource(Chunk, '/api/v1/chunks/<string:day>/<int:camid>/<string:chunk>')
 api.add_resource(Players, '/api/v1/players', '/api/v1/players/<int:playerid>')
 api.add_resource(Mats, '/api/v1/mats/<string:day>', '/api/v1/mats/<string:day>/<int:matid>')
+api.add_resource(MatItems, '/api/v1/mats/<string:day>/<int:matid>/<string:kind>', '/api/v1/mats/<string:day>/<int:matid>/<string:kind>/<string:itemid>')
+api.add_resource(Replication, '/api/v1/replication')
+api.add_resource(Sync, '/api/v1/sync')
+api.add_resource(Events, '/api/v1/events')
+api.add_resource(Recorders, '/api/v1/recorders')
+api.add_resource(Placement, '/api/v1/placement')
+api.add_resource(Deletions, '/api/v1/deletions', '/api/v1/deletions/<int:jobid>')
+api.add_resource(Metrics, '/metrics')
+
+
+def probe_cam(camid):
+    # RTSP connect probe, no fork/exec and no raw socket privileges needed
+    try:
+        socket.create_connection((CAMHOST % camid, CAMPROBEPORT), timeout=CAMPROBETIMEOUT).close()
+        return True
+    except OSError:
+        return False
+
+
+def camprobe_thread():
+    global camalive
+    print("CAMPROBE thread start")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAXCAM) as executor:
+        while True:
+            start = time.time()
+            camids = range(1, MAXCAM+1)
+            alive = set(camid for camid, up in zip(camids, executor.map(probe_cam, camids)) if up)
+            changed = sorted(alive ^ camalive)
+            camalive = alive
+            for camid in changed:
+                liveevents.put(("cam", camid, camid in alive))
+            time.sleep(max(0, CAMPROBEINTERVAL - (time.time() - start)))
+
+
+def heartbeat_thread():
+    print("HEARTBEAT thread start")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    seq = 0
+    while True:
+        seq += 1
+        # leases: cams recorded here, renewed with every heartbeat
+        owns, handover = leases
+        load = capacity(len(owns))
+        hb = dict(srvid=srvid_own, seq=seq, recording=recording, owns=owns, load=load, handover=handover,
+                  versions={name: store.version for name, store in stores.items()})
+        try:
+            sock.sendto(json.dumps(hb).encode(), (HBADDR, HBPORT))
+        except OSError as e:
+            print(f"srv.py: heartbeat send failed {e}")
+        hbwake.wait(HBINTERVAL)
+        hbwake.clear()
+
+
+def membership_thread():
+    # hysteresis failure detector: alive after HBJOIN consecutive heartbeats,
+    # dead after HBDEAD seconds of silence (several lost datagrams in a row)
+    print("MEMBERSHIP thread start")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', HBPORT))
+    sock.settimeout(HBINTERVAL / 2)
+    while True:
+        try:
+            data, addr = sock.recvfrom(65536)
+            hb = json.loads(data)
+            srvid = int(hb["srvid"])
+        except socket.timeout:
+            hb = None
+        except (ValueError, KeyError, TypeError):
+            print("srv.py: heartbeat invalid")
+            continue
+        now = time.time()
+        with memberslock:
+            if hb and srvid != srvid_own:
+                if srvid not in members or now - members[srvid]["seen"] > HBDEAD:
+                    members[srvid] = dict(alive=False, count=0, seen=now)
+                member = members[srvid]
+                if member.get("owns", {}) != hb.get("owns", {}):
+                    liveevents.put(("lease", srvid, True))
+                if member.get("handover", {}) != hb.get("handover", {}):
+                    liveevents.put(("lease", srvid, True))
+                member.update(addr=addr[0], seen=now, quiet=False, count=member["count"]+1, recording=hb.get("recording", False), versions=hb.get("versions", {}),
+                              owns=hb.get("owns", {}), load=hb.get("load", {}), handover=hb.get("handover", {}))
+                if not member["alive"] and member["count"] >= HBJOIN:
+                    member["alive"] = True
+                    liveevents.put(("srv", srvid, True))
+            for srvid, member in members.items():
+                if member["alive"] and not member.get("quiet") and now - member["seen"] > LEASECONFIRM:
+                    member["quiet"] = True
+                    liveevents.put(("lease", srvid, False))
+                if member["alive"] and now - member["seen"] > HBDEAD:
+                    member["alive"] = False
+                    liveevents.put(("srv", srvid, False))
+
+
+def alive_srvs():
+    with memberslock:
+        return [srvid for srvid, member in members.items() if member["alive"]]
+
+
+def leaseconfirmed():
+    # own leases hold only while every alive member is heard from
+    with memberslock:
+        return not any(member["alive"] and member.get("quiet") for member in members.values())
+
+
+def leaseholder(camid, alive):
+    # (epoch, srvid) of the live lease: recorded here or announced in heartbeats of alive members
+    with memberslock:
+        claims = [(member["owns"][str(camid)], srvid) for srvid, member in members.items() if srvid in alive and str(camid) in member.get("owns", {})]
+    with lock:
+        cam = cams.get(camid)
+        if cam and cam["srvid"] == srvid_own and cam["state"] == "owned":
+            claims.append((cam["epoch"], srvid_own))
+    return max(claims) if claims else None
+
+
+def adoptlease(camid, alive):
+    # the highest (epoch, srvid) lease holds the cam, an older one (healed split) stops recording
+    holder = leaseholder(camid, alive)
+    with lock:
+        cam = cams.get(camid)
+        if not holder:
+            if cam and cam["state"] == "owned" and cam["srvid"] != srvid_own:
+                # lease not renewed: owner gone or no longer records it
+                del cams[camid]
+            return
+        epoch, srvid = holder
+        epochs[camid] = max(epochs.get(camid, 0), epoch)
+        if cam and cam["srvid"] == srvid and cam["epoch"] == epoch and cam["state"] == "owned":
+            return
+        if cam and cam["srvid"] == srvid_own and cam["state"] == "owned":
+            print(f"srv.py: lease lost srv{srvid_own} cam{camid} to srv{srvid} epoch {epoch}")
+            supervisor.stop(camid)
+        cams[camid] = dict(srvid=srvid, epoch=epoch, state="owned", ts=time.time())
+        publishleases()
+
+
+def writtenbytes():
+    # sectors written on the block device of the share, 0 for network or virtual filesystems
+    dev = os.stat(SHARE).st_dev
+    try:
+        with open(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}/stat", "r") as f:
+            return int(f.read().split()[6]) * 512
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def capacity(recorders):
+    # load announced in heartbeats, rates refreshed once a second, rounded so all servers rank alike
+    global ownload
+    now = time.time()
+    if now - ownload.get("ts", 0) >= 1.0:
+        written = writtenbytes()
+        wbps = (written - ownload["written"]) / (now - ownload["ts"]) if ownload else 0
+        ownload = dict(ts=now, written=written, cpu=round(os.getloadavg()[0] / os.cpu_count(), 1),
+                       free=shutil.disk_usage(SHARE).free, wbps=max(0, int(wbps)))
+    return dict(recorders=recorders, cpu=ownload["cpu"], free=ownload["free"], wbps=ownload["wbps"], sees=sorted(camalive))
+
+
+def score(load):
+    # one recorder, one loaded core or PLACEWRITEUNIT bytes/s written count the same
+    return load.get("recorders", 0) + load.get("cpu", 0) + round(load.get("wbps", 0) / PLACEWRITEUNIT, 1)
+
+
+def loads(alive):
+    with memberslock:
+        _loads = {srvid: member.get("load", {}) for srvid, member in members.items() if srvid in alive}
+    if ownload:
+        with lock:
+            recorders = sum(1 for cam in cams.values() if cam["srvid"] == srvid_own and cam["state"] == "owned")
+        _loads[srvid_own] = capacity(recorders)
+    return _loads
+
+
+def place(camid, alive, assigned):
+    # released handover first, else the least loaded server that sees the cam and has room,
+    # cams placed in this sweep count as load, ties by rendezvous hash
+    with memberslock:
+        hints = [member["handover"][str(camid)] for srvid, member in members.items() if srvid in alive and str(camid) in member.get("handover", {})]
+    if hints:
+        return hints[0]
+    _loads = loads(alive)
+    candidates = [srvid for srvid, load in _loads.items() if camid in load.get("sees", [])] or [srvid_own]
+    roomy = [srvid for srvid in candidates if _loads.get(srvid, {}).get("free", PLACEFREEMIN) >= PLACEFREEMIN] or candidates
+    srvid = min(roomy, key=lambda srvid: (score(_loads.get(srvid, {})) + assigned.get(srvid, 0), hashlib.sha1(f"{camid}-{srvid}".encode()).digest()))
+    assigned[srvid] = assigned.get(srvid, 0) + 1
+    return srvid
+
+
+def rebalance(alive):
+    # hand one cam to a server scoring REBALANCEGAP less (or any with room when the share here runs
+    # out of space), released at the next chunk boundary; only once the load picture is settled:
+    # no tentative lease, every server's announced recorders match its leases, unchanged for
+    # REBALANCESTABLE seconds
+    global rebalanced, settled
+    _loads = loads(alive)
+    with lock:
+        leases = {srvid: sum(1 for cam in cams.values() if cam["srvid"] == srvid and cam["state"] == "owned") for srvid in _loads}
+        tentative = any(cam["state"] != "owned" for cam in cams.values())
+    picture = tuple(sorted((srvid, load.get("recorders", 0)) for srvid, load in _loads.items()))
+    if tentative or any(load.get("recorders", 0) != leases[srvid] for srvid, load in _loads.items()) or picture != settled[0]:
+        settled = (None if tentative else picture, time.time())
+        return
+    if time.time() - settled[1] < REBALANCESTABLE or time.time() - rebalanced < REBALANCEINTERVAL or time.time() < LEASESTART:
+        return
+    ownscore = score(_loads.get(srvid_own, {}))
+    full = _loads.get(srvid_own, {}).get("free", PLACEFREEMIN) < PLACEFREEMIN
+    with lock:
+        if handovers:
+            return
+        own = [camid for camid, cam in cams.items() if cam["srvid"] == srvid_own and cam["state"] == "owned"]
+        for camid in own:
+            targets = [srvid for srvid, load in _loads.items() if srvid != srvid_own and camid in load.get("sees", []) and
+                       load.get("free", 0) >= PLACEFREEMIN and (full or ownscore - score(load) >= REBALANCEGAP)]
+            if targets:
+                target = min(targets, key=lambda srvid: score(_loads[srvid]))
+                handovers[camid] = dict(srvid=target, ts=time.time(), boundary=False, released=None)
+                rebalanced = time.time()
+                print(f"srv.py: rebalance cam{camid:02d} to srv{target} at next chunk")
+                return
+
+
+def handoff(alive):
+    # release cams at their chunk boundary (or after HANDOVERWAIT), forget finished handovers
+    with lock:
+        for camid, handover in list(handovers.items()):
+            cam = cams.get(camid)
+            if not handover["released"]:
+                if not cam or cam["srvid"] != srvid_own or cam["state"] != "owned":
+                    del handovers[camid]
+                elif handover["boundary"] or time.time() - handover["ts"] > HANDOVERWAIT:
+                    print(f"srv.py: handover cam{camid:02d} to srv{handover['srvid']}")
+                    supervisor.stop(camid)
+                    cams[camid] = dict(srvid=handover["srvid"], epoch=cam["epoch"], state="tentative", ts=time.time())
+                    handover["released"] = time.time()
+                    publishleases()
+                    hbwake.set()
+            elif (cam and cam["srvid"] == handover["srvid"] and cam["state"] == "owned") or time.time() - handover["released"] > 4 * LEASEGRACE:
+                del handovers[camid]
+
+
+def propose(camid, alive):
+    # one parallel round under one RPCTIMEOUT deadline, no alive peer may refuse (srvid_own, epoch);
+    # peers not answering in time are left out, a lease granted twice that way (HTTP split, UDP
+    # heartbeats still flowing) is settled by adoptlease() once the leases show up in heartbeats
+    with lock:
+        epoch = epochs.get(camid, 0) + 1
+        epochs[camid] = epoch
+        cams[camid] = dict(srvid=srvid_own, epoch=epoch, state="tentative", ts=time.time())
+    futures = {srvid: leaseexecutor.submit(peerclient.put, srvid, RESTURIRECORDINGCAM, camid, json=dict(srvid=srvid_own, epoch=epoch), retries=0)
+               for srvid in alive if srvid != srvid_own}
+    done, _ = concurrent.futures.wait(futures.values(), timeout=RPCTIMEOUT)
+    granted = True
+    for srvid, future in futures.items():
+        try:
+            if future not in done:
+                raise TimeoutError
+            reply = future.result().json()
+            if not isinstance(reply["granted"], bool):
+                raise ValueError
+            refused, known = not reply["granted"], int(reply["epoch"])
+        except:
+            # malformed replies (errors, other versions) count as no answer
+            print(f"srv.py: lease srv{srvid} no answer, left out")
+            continue
+        if refused:
+            granted = False
+            with lock:
+                epochs[camid] = max(epochs.get(camid, 0), known)
+    with lock:
+        cam = cams.get(camid)
+        # a lower srvid proposal granted here in the meantime replaced ours
+        if cam and cam["srvid"] == srvid_own and cam["epoch"] == epoch:
+            if granted:
+                cam["state"] = "owned"
+                publishleases()
+                print(f"srv.py: lease srv{srvid_own} cam{camid} epoch {epoch}")
+                return True
+            del cams[camid]
+    return False
 
 
 def live_thread():
-    global cfgs, srvs, cams, recording
+    global srvs, cams, recording
     print("LIVE thread start")
-    while True:
-        for srvid in range(1, 9):
-            if srvid == srvid_own:
-                continue
-            if subprocess.run(["/usr/bin/ping", "-c", "1", "-W", "0.1", f"srv{srvid:d}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
-                add_srv(srvid)
-            if srvid in srvs:
-                try:
-                    requests.get(RESTURICAMS % (srvid), timeout=1)
-                except:
-                    print(f"srv.py: DELETING srv{srvid}")
-                    with lock:
-                        for camid in [camid for camid in cams if cams[camid]["srvid"] == srvid]:
-                            del cams[camid]
-                        del srvs[srvid]
-                        loadcfg()
-                        loadplayers()
-                        loadmats()
-            time.sleep(0.1)
-
-        for camid in range(1, 33):
-            if subprocess.run(["/usr/bin/ping", "-c", "1", "-W", "0.1", f"cam{camid:02d}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
-                if camid not in cams:
-                    print(f"srv.py: ADD cam{camid:02d}")
-                    win_srvid = None
-                    win_ts = MAXTS
-
-                    # first try do receive actual cam streaming
-                    with lock:
-                        _srvs = list(srvs.keys())
-                    for srvid in _srvs:
-                        try:
-                            camrec = requests.get(RESTURIRECORDINGCAM % (srvid, camid), timeout=1).json()
-                            if camrec["ts"] < win_ts:
-                                win_srvid = camrec["srvid"]
-                                win_ts = camrec["ts"]
-                        except:
-                            print("srv.py: conn error", get_linenumber())
-                    if win_srvid:
-                        # found actual cam streaming
-                        with lock:
-                            cams[camid] = dict(srvid=win_srvid, ts=win_ts, process=None, checker=0)
-                        print(f"srv.py: scan winner srv{win_srvid} cam{camid}")
-                    else:
-                        # create new cam streaming
-                        with lock:
-                            ts = int(time.time()*1000)*10+srvid_own
-                            cams[camid] = dict(srvid=srvid_own, ts=ts, process=None, checker=CHECKER)
-
-                        # push srvid_our if not overriden
-                        with lock:
-                            _srvs = list(srvs.keys())
-                        for srvid in _srvs:
-                            if cams[camid]["srvid"] == srvid_own:
-                                try:
-                                    requests.put(RESTURIRECORDINGCAM % (srvid, camid), json=dict(srvid=srvid_own, ts=ts), timeout=1)
-                                except:
-                                    print("srv.py: conn error", get_linenumber())
-
-                # check for validity
-                if cams[camid]["checker"] > 0:
-                    cams[camid]["checker"] -= 1
-                    if cams[camid]["srvid"] == srvid_own:
-                        with lock:
-                            _srvs = list(srvs.keys())
-                        for srvid in _srvs:
+    while not stopping.is_set():
+        start = time.perf_counter()
+        alive = alive_srvs()
+        for srvid in alive:
+            add_srv(srvid)
+        for srvid in [srvid for srvid in list(srvs.keys()) if srvid not in alive]:
+            drop_srv(srvid)
+        confirmed = leaseconfirmed()
+        if not confirmed:
+            # cut off from an alive member: stop recording before it takes the cams over
+            with lock:
+                for camid in [camid for camid, cam in cams.items() if cam["srvid"] == srvid_own and cam["state"] == "owned"]:
+                    print(f"srv.py: lease cam{camid:02d} unconfirmed, released")
+                    supervisor.stop(camid)
+                    del cams[camid]
+                publishleases()
+                hbwake.set()
+
+        assigned = {}
+        for camid in range(1, MAXCAM+1):
+            if camid in camalive:
+                adoptlease(camid, alive)
+                with lock:
+                    cam = cams.get(camid)
+                    # no lease or an unconfirmed proposal went stale
+                    orphan = cam is None or (cam["state"] == "tentative" and time.time() - cam["ts"] > LEASEGRACE)
+                if orphan:
+                    if camid not in orphaned:
+                        print(f"srv.py: ADD cam{camid:02d}")
+                        orphaned[camid] = time.time()
+                    # preferred server proposes at once, the others after LEASEGRACE
+                    if confirmed and time.time() > LEASESTART and time.time() >= retryat.get(camid, 0) and (place(camid, alive, assigned) == srvid_own or time.time() - orphaned[camid] > LEASEGRACE):
+                        if not propose(camid, alive):
+                            retryat[camid] = time.time() + random.uniform(0, LEASEGRACE)
+                else:
+                    orphaned.pop(camid, None)
+
+                if camid in cams:
+                    # extend config for new cam if needed
+                    if str(camid) not in cfgstore.get()[today]:
+                        for srvid in list(srvs.keys()):
                             try:
-                                response = requests.get(RESTURIRECORDINGCAM % (srvid, camid), timeout=1)
-                                if response.json()["srvid"] != srvid_own:
-                                    print(f"srv.py: arbitration collision on srv{srvid} is srv{response.json()['srvid']} cam{camid}")
-                                    with lock:
-                                        del cams[camid]
-                                    break
+                                sync_srv(srvid)
                             except:
                                 print("srv.py: conn error", get_linenumber())
-                        else:
-                            print(f"srv.py: arbitration winner srv{cams[camid]['srvid']} cam{camid}")
-                    else:
-                        cams[camid]["checker"] = 0
-                        print(f"srv.py: arbitration remote winner srv{cams[camid]['srvid']} cam{camid}")
-
-                if camid in cams:
-                    with lock:
-                        # extend config for new cam if needed
-                        if str(camid) not in cfgs[today]:
-                            loadcfg()
+                        ticket = 0
+                        with cfgstore.lock:
+                            cfgs = cfgstore.get()
                             if str(camid) not in cfgs[today]:
-                                for (m, p) in [(m, p) for m in range(1, MAXMAT+1) for p in range(1, MAXPOS+1)]:
-                                    for cam in cfgs[today].values():
-                                        if cam["mat"] == m and cam["position"] == p:
-                                            break
-                                    else:
-                                        break
-                                cfgs[today][str(camid)] = dict(mat=m, position=p)
-                                savecfg()
+                                cfgstore.swap(replaced(cfgs, today, replaced(cfgs[today], str(camid), freeposition(cfgs[today]))))
+                                ticket = commit(today, "cams", cfgs[today], cfgstore.get()[today])
+                        journal.wait(ticket)
 
+                    with lock:
                         # check and start/stop
-                        (m, p) = (cfgs[today][str(camid)]["mat"], cfgs[today][str(camid)]["position"])
-                        if recording:
-                            if cams[camid]["srvid"] == srvid_own and cams[camid]["checker"] == 0 and (not cams[camid]["process"] or cams[camid]["process"].poll()):
-                                print(f"srv.py: START cam{camid:02d}")
-                                cams[camid]["process"] = subprocess.Popen([CAMEXEC, f"/share/{hostname}/{today}/", f"cam{camid:02d}", f"{m}", f"{p}"])
+                        cam = cfgstore.get()[today][str(camid)]
+                        (m, p) = (cam["mat"], cam["position"])
+                        if recording and not stopping.is_set():
+                            if cams[camid]["srvid"] == srvid_own and cams[camid]["state"] == "owned":
+                                supervisor.record(camid, [CAMEXEC, f"{SHARE}/{hostname}/{today}/", f"cam{camid:02d}", f"{m}", f"{p}"])
                         else:
-                            if cams[camid]["process"]:
-                                print(f"srv.py: STOP cam{camid:02d}")
-                                cams[camid]["process"].terminate()
-                                cams[camid]["process"] = None
+                            supervisor.stop(camid)
             else:
                 with lock:
                     if camid in cams:
                         print(f"srv.py: DELETE cam{camid:02d}")
-                        if cams[camid]["process"]:
-                            cams[camid]["process"].terminate()
+                        supervisor.stop(camid)
                         del cams[camid]
-            time.sleep(0.1)
+                        publishleases()
+
+        handoff(alive)
+        rebalance(alive)
+        with lock:
+            publishleases()
+        publishowners()
+        metrics.observe("jcsrv_live_cycle_seconds", time.perf_counter() - start)
+
+        # wait for next sweep, wake up immediately on camera up/down or membership change
+        try:
+            kind, key, up = liveevents.get(timeout=CAMPROBEINTERVAL)
+            while True:
+                if kind == "cam":
+                    print(f"srv.py: probe cam{key:02d} {'up' if up else 'down'}")
+                elif kind == "srv":
+                    print(f"srv.py: member srv{key} {'join' if up else 'leave'}")
+                kind, key, up = liveevents.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class Supervisor:
+    # CAMEXEC children watched through pidfd: reaped as soon as they exit and restarted with
+    # exponential backoff while still wanted, polling fallback without pidfd
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recorders = {}
+        self.rpipe, self.wpipe = os.pipe()
+
+    def wake(self):
+        os.write(self.wpipe, b"x")
+
+    def launch(self, camid, recorder):
+        recorder["due"] = None
+        try:
+            recorder["process"] = subprocess.Popen(recorder["argv"])
+        except OSError as e:
+            print(f"srv.py: START cam{camid:02d} failed {e}")
+            recorder["process"] = None
+            self.backoff(camid, recorder, 0)
+            return
+        recorder["started"] = time.time()
+        try:
+            recorder["pidfd"] = os.pidfd_open(recorder["process"].pid)
+        except (AttributeError, OSError):
+            recorder["pidfd"] = None
+        self.wake()
+
+    def backoff(self, camid, recorder, uptime):
+        # first exit after a healthy run restarts at once, quick crashes back off up to RECBACKOFFMAX
+        recorder["fails"] = 1 if uptime >= RECBACKOFFRESET else recorder["fails"] + 1
+        delay = 0 if recorder["fails"] <= 1 else min(RECBACKOFFMAX, RECBACKOFFMIN * 2 ** (recorder["fails"] - 2))
+        recorder["due"] = time.time() + delay
+        print(f"srv.py: RESTART cam{camid:02d} exit {recorder['exitcode']} in {delay:.1f}s")
+        self.wake()
+
+    def record(self, camid, argv):
+        # idempotent, a running recorder keeps going and gets argv on its next restart
+        with self.lock:
+            recorder = self.recorders.get(camid)
+            if recorder:
+                recorder["argv"] = argv
+                recorder["wanted"] = True
+                return
+            print(f"srv.py: START cam{camid:02d}")
+            recorder = self.recorders[camid] = dict(argv=argv, wanted=True, pidfd=None, started=None,
+                                                    restarts=0, fails=0, exitcode=None, due=None)
+            self.launch(camid, recorder)
+
+    def stop(self, camid):
+        with self.lock:
+            recorder = self.recorders.get(camid)
+            if recorder and recorder["wanted"]:
+                print(f"srv.py: STOP cam{camid:02d}")
+                recorder["wanted"] = False
+                if recorder["process"]:
+                    recorder["process"].terminate()
+                else:
+                    del self.recorders[camid]
+
+    def wait(self, camids, timeout=SRVSTOPTIMEOUT):
+        # until stopped recorders of camids are reaped
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if not any(camid in self.recorders and self.recorders[camid]["process"] for camid in camids):
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def exited(self, camid, recorder):
+        # reap, then restart or forget
+        recorder["exitcode"] = recorder["process"].wait()
+        if recorder["pidfd"] is not None:
+            os.close(recorder["pidfd"])
+        recorder["process"], recorder["pidfd"] = None, None
+        if recorder["wanted"] and not stopping.is_set():
+            recorder["restarts"] += 1
+            metrics.inc("jcsrv_recorder_restarts_total", camid=camid)
+            self.backoff(camid, recorder, time.time() - recorder["started"])
+        else:
+            del self.recorders[camid]
+
+    def run(self):
+        print("SUPERVISOR thread start")
+        while True:
+            with self.lock:
+                pidfds = {recorder["pidfd"]: camid for camid, recorder in self.recorders.items() if recorder["pidfd"] is not None}
+                polled = any(recorder["process"] and recorder["pidfd"] is None for recorder in self.recorders.values())
+                dues = [recorder["due"] for recorder in self.recorders.values() if recorder["due"] is not None]
+            timeout = min([max(0, due - time.time()) for due in dues] + ([RECPOLL] if polled else []), default=None)
+            poller = select.poll()
+            poller.register(self.rpipe, select.POLLIN)
+            for pidfd in pidfds:
+                poller.register(pidfd, select.POLLIN)
+            ready = [fd for fd, mask in poller.poll(None if timeout is None else timeout * 1000)]
+            if self.rpipe in ready:
+                os.read(self.rpipe, 4096)
+            with self.lock:
+                for camid, recorder in list(self.recorders.items()):
+                    if recorder["process"] and (recorder["pidfd"] in ready if recorder["pidfd"] is not None else recorder["process"].poll() is not None):
+                        self.exited(camid, recorder)
+                    elif recorder["due"] is not None and recorder["due"] <= time.time():
+                        if recorder["wanted"] and not stopping.is_set():
+                            self.launch(camid, recorder)
+                        else:
+                            del self.recorders[camid]
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            recorders = {camid: dict(recorder) for camid, recorder in self.recorders.items()}
+        stats = {}
+        for camid, recorder in recorders.items():
+            stat = dict(running=recorder["process"] is not None, wanted=recorder["wanted"], restarts=recorder["restarts"],
+                        exitcode=recorder["exitcode"], uptime=None, backoff=None, pid=None, cpu=None, rss=None)
+            if recorder["process"]:
+                stat["pid"] = recorder["process"].pid
+                stat["uptime"] = round(now - recorder["started"], 1)
+                try:
+                    with open(f"/proc/{stat['pid']}/stat", "r") as f:
+                        fields = f.read().rsplit(")", 1)[1].split()
+                    # utime + stime in seconds, resident set in bytes
+                    stat["cpu"] = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+                    stat["rss"] = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+                except (OSError, IndexError, ValueError):
+                    pass
+            elif recorder["due"] is not None:
+                stat["backoff"] = round(max(0, recorder["due"] - now), 1)
+            stats[str(camid)] = stat
+        return stats
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stopall(self):
+        # terminate every child and reap it, kill the ones ignoring SIGTERM
+        with self.lock:
+            processes = [(camid, recorder["process"]) for camid, recorder in self.recorders.items() if recorder["process"]]
+            for camid, recorder in self.recorders.items():
+                recorder["wanted"] = False
+        for camid, process in processes:
+            print(f"srv.py: STOP cam{camid:02d}")
+            process.terminate()
+        deadline = time.time() + SRVSTOPTIMEOUT
+        for camid, process in processes:
+            try:
+                process.wait(timeout=max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                print(f"srv.py: KILL cam{camid:02d}")
+                process.kill()
+                process.wait()
+
+
+supervisor = Supervisor()
+
+
+def shutdown(signum, frame):
+    print(f"srv.py: SHUTDOWN signal {signum}")
+    stopping.set()
+    raise SystemExit(0)
+
+
+def serve():
+    # bounded worker pool with keep-alive and idle timeout, flask development server as fallback
+    if SERVER == "waitress" and waitress:
+        # streams never take the SRVTHREADS request workers, they are capped at EVENTSCLIENTS
+        connlimit = max(SRVCONNLIMIT, SRVTHREADS + 2 * EVENTSCLIENTS)
+        server = waitress.create_server(app, host='0.0.0.0', port=PORT, threads=SRVTHREADS + EVENTSCLIENTS, connection_limit=connlimit,
+                                        channel_timeout=SRVIDLETIMEOUT, ident="jc-srv")
+        print(f"srv.py: waitress threads {SRVTHREADS} + {EVENTSCLIENTS} event streams, connections {connlimit}")
+        try:
+            server.run()
+        finally:
+            # finish requests in flight, end event streams
+            with events.cond:
+                events.cond.notify_all()
+            server.task_dispatcher.shutdown(timeout=SRVSTOPTIMEOUT)
+    else:
+        if SERVER == "waitress":
+            print("srv.py: waitress not installed, flask development server")
+        app.run(threaded=True, host='0.0.0.0', port=PORT)
 
 
 if __name__ == '__main__':
     print("VERSION v1.2024-12-10")
     recording = os.path.exists(recordingfile)
-    with lock:
-        if not os.path.exists(f"/share/{hostname}/{today}/cams.cfg"):
-            cfgs[today] = {}
-        loadcfg()
-        loadplayers()
-        loadmats()
+    loadcfg()
+    loadplayers()
+    loadmats()
+    peerids.start()
+    journal.start()
+    supervisor.start()
+    deleter.start()
+    replicator.load()
+    chunkindex.start()
+    chunkcache.load()
+    chunkcache.start()
+
+    camprobetid = threading.Thread(target=camprobe_thread, daemon=True)
+    camprobetid.start()
+
+    heartbeattid = threading.Thread(target=heartbeat_thread, daemon=True)
+    heartbeattid.start()
+    membershiptid = threading.Thread(target=membership_thread, daemon=True)
+    membershiptid.start()
 
     livetid = threading.Thread(target=live_thread)
     livetid.start()
 
-    app.run(threaded=True, host='0.0.0.0')
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    try:
+        serve()
+    finally:
+        stopping.set()
+        livetid.join(timeout=SRVSTOPTIMEOUT)
+        supervisor.stopall()
+        try:
+            journal.wait(journal.seq)
+        except OSError:
+            # already reported by the flush thread
+            pass
+        chunkcache.save()
+        print("srv.py: STOPPED")